@@ -0,0 +1,171 @@
+# Benchmarks for the parse / edit / serialize paths of pyson on synthetic projects. Doesn't need Sonnet.
+#
+#   python benchmark.py
+#   python benchmark.py --sizes 10 100 1000 10000 100000 --ports 64 --layers 20 --output bench_output.txt
+#   python benchmark.py --sizes 10 --import-budget 0.3
+
+from time import perf_counter
+import argparse
+import subprocess
+import tempfile
+import sys
+import warnings
+import os
+
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib import pyplot as plt
+
+import pyson
+
+def synthetic_son(file_name, polygons, ports=4, layers=2, vertices=5):
+    # Grid of square polygons (closed, so vertices-1 corners), ports on the first polygons and a stack of layers
+    side = int(np.ceil(np.sqrt(polygons)))
+    pitch = 10
+    size = side * pitch + 2*pitch
+    geo = ['TMET "Lossless" 0 SUP 0 0 0 0', 'BMET "Lossless" 0 SUP 0 0 0 0',
+           f"BOX {layers-1} {size} {size} {2*size} {2*size} 20 0"]
+    for i in range(layers):
+        geo.append(f'      {50+i} 11.7 1 0 0 0 0 "Layer{i}"')
+    for i in range(min(ports, polygons)):
+        x = pitch + (i % side) * pitch
+        y = pitch + (i // side) * pitch
+        geo += ["POR1 STD", f"POLY {i+1} 1", "0", f"{i+1} 50 0 0 0 {x+2.5} {y}"]
+    geo.append(f"NUM {polygons}")
+    angles = np.linspace(0, 2*np.pi, vertices)[:-1] + np.pi/4
+    corners = np.stack([np.cos(angles), np.sin(angles)], axis=1) * 2.5 * np.sqrt(2) + 2.5
+    for i in range(polygons):
+        x = pitch + (i % side) * pitch
+        y = pitch + (i // side) * pitch
+        geo.append(f"0 {vertices} -1 N {i+1} 1 1 100 100 0 0 0 Y")
+        for cx, cy in list(corners) + [corners[0]]:
+            geo.append(f"{x+cx:.4f} {y+cy:.4f}")
+        geo.append("END")
+
+    with open(file_name, "w") as f:
+        f.write("FTYP SONPROJ 16.52 ! Sonnet Project File\nVER 16.52\n")
+        f.write("HEADER\nDAT 01/01/2024 00:00:00\nEND HEADER\n")
+        f.write("DIM\nLNG UM\nFREQ GHZ\nEND DIM\n")
+        f.write("FREQ\nABS 6 8\nEND FREQ\n")
+        f.write("CONTROL\nABS\nSPEED 0\nEND CONTROL\n")
+        f.write("GEO\n" + "\n".join(geo) + "\nEND GEO\n")
+        f.write("OPT\nMAX 100\nEND OPT\nFILEOUT\nEND FILEOUT\n")
+    return size
+
+def import_time(repeat=3):
+    # Best time to import pyson in a fresh interpreter, as a worker process would
+    code = "from time import perf_counter; start = perf_counter(); import pyson; print(perf_counter() - start)"
+    here = os.path.dirname(os.path.abspath(__file__))
+    return min(float(subprocess.run([sys.executable, "-c", code], cwd=here, capture_output=True, text=True,
+                                     check=True).stdout) for _ in range(repeat))
+
+def timed(func, setup=None, repeat=3):
+    # Best of repeat runs, setup isn't timed and its result is passed to func
+    best = float("inf")
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        start = perf_counter()
+        func(arg)
+        best = min(best, perf_counter() - start)
+    return best
+
+def run_size(work_dir, n, ports, layers, repeat, draw_max):
+    file_name = os.path.join(work_dir, f"bench-{n}.son")
+    out_name = os.path.join(work_dir, f"bench-{n}-out.son")
+    size = synthetic_son(file_name, n, ports=ports, layers=layers)
+    unpacked = pyson.unpack_son(file_name)
+    polygons = pyson.extract_polygons(unpacked)
+    project = lambda: pyson.open_son(file_name)
+    inserts = 100
+    square = np.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=float)
+
+    results = {}
+    results["unpack_son"] = timed(lambda _: pyson.unpack_son(file_name), repeat=repeat)
+    results["extract_polygons"] = timed(lambda _: pyson.extract_polygons(unpacked), repeat=repeat)
+    results["extract_box"] = timed(lambda _: pyson.extract_box(unpacked), repeat=repeat)
+    results["extract_ports"] = timed(lambda _: pyson.extract_ports(unpacked), repeat=repeat)
+    results["repack_geo"] = timed(lambda _: pyson.repack_geo(unpacked, polygons=polygons), repeat=repeat)
+    results["repack_son"] = timed(lambda _: pyson.repack_son(out_name, unpacked), repeat=repeat)
+    # Per insert, averaged over a run of inserts into the same project
+    results["add_metal_polygon"] = timed(lambda p: [p.add_metal_polygon(0, *square.T) for _ in range(inserts)],
+                                         setup=project, repeat=repeat) / inserts
+    results["add_metal_polygons"] = timed(lambda p: p.add_metal_polygons(0, np.repeat(square[None], inserts, axis=0)),
+                                          setup=project, repeat=repeat) / inserts
+    # Crop window edges fall in the gaps between cells
+    lo = 10 * round(size / 40) + 7.5
+    hi = 10 * round(3 * size / 40) + 7.5
+    results["crop"] = timed(lambda p: p.crop(lo, lo, hi, hi), setup=project, repeat=repeat)
+    if n <= draw_max:
+        def draw(p):
+            fig, _ = p.draw()
+            plt.close(fig)
+        results["draw"] = timed(draw, setup=project, repeat=1)
+    return results
+
+def scaling(sizes, times):
+    # Exponent of a power law fit, 1 is linear and 2 quadratic
+    sizes, times = np.array(sizes, dtype=float), np.array(times, dtype=float)
+    if len(sizes) < 2 or np.any(times <= 0):
+        return float("nan")
+    return np.polyfit(np.log(sizes), np.log(times), 1)[0]
+
+def report(sizes, results):
+    names = list(results[sizes[0]])
+    lines = ["Time in seconds (add_metal_polygon(s) per polygon)", ""]
+    lines.append(f"{'':20}" + "".join(f"{n:>12}" for n in sizes) + f"{'scaling':>10}")
+    for name in names:
+        row = [results[n].get(name) for n in sizes]
+        measured = [(n, t) for n, t in zip(sizes, row) if t is not None]
+        slope = scaling([m[0] for m in measured], [m[1] for m in measured])
+        lines.append(f"{name:20}" + "".join(f"{t:12.3e}" if t is not None else f"{'-':>12}" for t in row)
+                     + f"{slope:10.2f}")
+    return "\n".join(lines)
+
+def plot(sizes, results, file_name):
+    fig, ax = plt.subplots(figsize=(8, 6))
+    for name in results[sizes[0]]:
+        measured = [(n, results[n][name]) for n in sizes if name in results[n]]
+        ax.loglog(*zip(*measured), marker="o", label=name)
+    ax.set_xlabel("Polygons")
+    ax.set_ylabel("Time (s)")
+    ax.legend()
+    fig.savefig(file_name)
+    plt.close(fig)
+
+def main():
+    parser = argparse.ArgumentParser(description="Time pyson's parse / edit / serialize paths on synthetic projects.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000], help="numbers of polygons")
+    parser.add_argument("--ports", type=int, default=16, help="ports per project")
+    parser.add_argument("--layers", type=int, default=8, help="dielectric layers per project")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the best is kept")
+    parser.add_argument("--draw-max", type=int, default=10000, help="largest project to time draw on")
+    parser.add_argument("--output", default="", help="also write the report to this file")
+    parser.add_argument("--plot", default="", help="save scaling curves to this image")
+    parser.add_argument("--import-budget", type=float, default=0.5,
+                        help="seconds import pyson may take, exits with an error above it")
+    args = parser.parse_args()
+
+    start_time = import_time(args.repeat)
+    print(f"import pyson: {start_time:.3f} s (budget {args.import_budget} s)", flush=True)
+
+    warnings.simplefilter("ignore")
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for n in args.sizes:
+            results[n] = run_size(work_dir, n, args.ports, args.layers, args.repeat, args.draw_max)
+            print(f"{n} polygons done", flush=True)
+
+    text = f"import pyson: {start_time:.3e} s\n\n" + report(args.sizes, results)
+    print()
+    print(text)
+    if args.output != "":
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    if args.plot != "":
+        plot(args.sizes, results, args.plot)
+    if start_time > args.import_budget:
+        sys.exit(f"import pyson took {start_time:.3f} s, over the {args.import_budget} s budget")
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,65 @@
-from copy import copy
-from matplotlib import pyplot as plt
-from shapely.geometry import Polygon as ShapelyPolygon, Point
-from shapely.geometry import MultiPolygon as ShapelyMultiPolygon
+from copy import copy, deepcopy
 from datetime import datetime
-from random import randint, seed
+from concurrent.futures import ThreadPoolExecutor, Future
 import numpy as np
 import warnings
-import skrf as rf
 import subprocess
+import tempfile
+import hashlib
+import pickle
+import asyncio
+import itertools
+import json
 import shutil
+import struct
+import zlib
+import importlib
+import mmap
+import threading
 import os
 
-# See if MATLAB Engine is installed
-ml_import = True
-try:
-    import matlab.engine
-except ImportError:
-    ml_import = False
-    pass
+class lazyModule:
+    # Stands in for a module and imports it the first time it is used, so importing pyson stays fast
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+# Heavy dependencies, only loaded by the functions that need them
+plt = lazyModule("matplotlib.pyplot")
+mpl_collections = lazyModule("matplotlib.collections")
+shapely = lazyModule("shapely")
+rf = lazyModule("skrf")
+matlab_engine = lazyModule("matlab.engine")
+
+def matlab_available():
+    # See if MATLAB Engine is installed, only tried once
+    global matlab_found
+    if matlab_found is None:
+        try:
+            matlab_engine.start_matlab
+            matlab_found = True
+        except ImportError:
+            matlab_found = False
+    return matlab_found
+
+matlab_found = None
+
+def __getattr__(name):
+    # pyson.ml_import stays a bool as before, but the import is only tried when it is read
+    if name == "ml_import":
+        return matlab_available()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 pyson_version = 0.2
 
 class sonnetFile:
     # Constructors / Destructors
-    def __init__(self,  file_name, temp, sonnet_path="", sonnet_version="", eng=None):
+    def __init__(self,  file_name, temp, sonnet_path="", sonnet_version="", eng=None, ml_var="Project", ml_pool=None):
         sp = ""
         sv = "18.53"
         if sonnet_path == "":
@@ -43,6 +79,14 @@ class sonnetFile:
             else:
                 warnings.warn(f"Sonnet installation not found.")
         self.eng = eng
+        self.ml_var = ml_var
+        self.ml_pool = ml_pool
+        self.current_batch = None
+        # Block name -> sharedValue, for blocks of son_dict that are still shared with a fork
+        self.shared_blocks = {}
+        self.fork_count = 0
+        # box_size / cell_size results, cleared by the change_* methods and anything that reloads the project
+        self.box_cache = {}
         self.file_name = file_name
         self.temp = temp
         self.ml_backend = eng is not None
@@ -50,7 +94,7 @@ class sonnetFile:
         self.sonnet_version = float(sv)
         if os.path.isdir(sp):
             self.sonnet_path = sp
-        elif sp != "":
+        else:
             self.sonnet_path = sonnet_path
 
     def __del__(self):
@@ -72,36 +116,35 @@ class sonnetFile:
                     shutil.rmtree(extradir)
 
         if self.ml_backend:
-            self.eng.quit()
+            if self.ml_pool is not None:
+                self.ml_pool.release(self.eng, self.ml_var)
+            else:
+                self.eng.quit()
 
     # Sonnetlab Functions
     def save(self, file_name=""):
         file_name = file_name if file_name != "" else self.file_name
-        if self.ml_backend:
-            if file_name == "":
-                self.eng.eval(f"Project.save();", nargout=0)
-            else:
-                self.eng.eval(f"Project.saveAs(\"{file_name}\");", nargout=0)
-
-            # Unpack the sonnet file and remove duplicate VALVAR lines (SonnetLab Bug)
-            unpacked = unpack_son(self.file_name)
-            out_geo = ""
-            valvar_lines = []
-            geo_split = unpacked["GEO"].split("\n")
-            for geo_line in range(len(geo_split)):
-                if "VALVAR" in geo_split[geo_line]:
-                    if geo_split[geo_line] in valvar_lines:
-                        continue
-                    else:
-                        valvar_lines.append(geo_split[geo_line])
-                out_geo += geo_split[geo_line] + "\n"
-            unpacked["GEO"] = out_geo
-            repack_son(file_name, unpacked)
-            self.file_name = file_name
+        if self.current_batch is not None:
+            # Saved once when the batch ends
+            self.current_batch.save_as = file_name
+        elif self.ml_backend:
+            self.ml_save(file_name)
         else:
             repack_son(file_name, self.son_dict)
             self.file_name = file_name
 
+    def ml_save(self, file_name):
+        if file_name == "":
+            self.eng.eval(f"{self.ml_var}.save();", nargout=0)
+        else:
+            self.eng.eval(f"{self.ml_var}.saveAs(\"{file_name}\");", nargout=0)
+
+        # Parsing the VALVAR table drops the duplicate VALVAR lines SonnetLab writes (SonnetLab Bug)
+        unpacked = unpack_son(file_name)
+        unpack_geo(unpacked)
+        repack_son(file_name, unpacked)
+        self.file_name = file_name
+
     def open_in_sonnet(self):
         self.save()
         subprocess.call(f"{self.sonnet_path}xgeom.exe {self.file_name}")
@@ -109,20 +152,27 @@ class sonnetFile:
 
     def add_metal_polygon(self, metalization_level, xcoords, ycoords, metal_type="", tech_layer="", inherit=True, header=[]):
         if self.ml_backend:
+            # y is flipped by MATLAB to save asking for the box size
+            xc = ml_vector(xcoords)
+            yc = f"{self.ml_var}.yBoxSize() - " + ml_vector(ycoords)
+            if(metal_type == ""):
+                add = f"{self.ml_var}.addMetalPolygonEasy({metalization_level}, {xc}, {yc}).DebugId"
+            elif(type(metal_type) == int):
+                add = f"{self.ml_var}.addMetalPolygonEasy({metalization_level}, {xc}, {yc}, {metal_type}).DebugId"
+            else:
+                add = f"{self.ml_var}.addMetalPolygonEasy({metalization_level}, {xc}, {yc}, \"{metal_type}\").DebugId"
+
+            if self.current_batch is not None:
+                # The id is in batch.ids once the batch has run
+                self.current_batch.add_polygon(add, tech_layer, inherit)
+                return None
+
             # Get list of polygons before adding new one if tech layer needs to be changed
             polygons = None
             if tech_layer != "":
                 polygons = extract_polygons(self.unpack())
 
-            # Convert a list of coordinates of the form [a,b,c,d] to a string of the form [a;b;c;d]
-            xc = str(xcoords).replace(",", ";")
-            yc = str(self.fix_y(ycoords)).replace(",", ";")
-            if(metal_type == ""):
-                self.eng.eval(f"polyId = Project.addMetalPolygonEasy({metalization_level}, {xc}, {yc}).DebugId;", nargout=0)
-            elif(type(metal_type) == int):
-                self.eng.eval(f"polyId = Project.addMetalPolygonEasy({metalization_level}, {xc}, {yc}, {metal_type}).DebugId;", nargout=0)
-            else:
-                self.eng.eval(f"polyId = Project.addMetalPolygonEasy({metalization_level}, {xc}, {yc}, \"{metal_type}\").DebugId;", nargout=0)
+            self.eng.eval(f"{self.ml_var}_id = {add};", nargout=0)
             self.save()
 
 
@@ -143,26 +193,21 @@ class sonnetFile:
                 repack_son(self.file_name, repack_geo(self.unpack(), polygons=polygons_new))
                 self.reload()
 
-            return int(self.eng.workspace["polyId"])
+            return int(self.eng.workspace[f"{self.ml_var}_id"])
         else:
-            polys = extract_polygons(self.son_dict)
-            poly_ids = [int(p[0][4]) for p in polys]
-            new_id = 1
-            while new_id in poly_ids:
-                new_id = randint(2, len(poly_ids)*10)
+            polys = self.geo().polygons
             inh = "" if tech_layer == "" else ("INH" if inherit else "NOH")
 
             new_header = []
             if header != []:
                 new_header = header
                 # This was originally header[2]? I think it should be header[4]
-                if self.sonnet_version >= 18.53:
-                    if header[4] == -1:
-                        new_header[4] = new_id
-                else:
-                    if header[2] == -1:
-                        new_header[2] = new_id
+                id_index = 4 if self.sonnet_version >= 18.53 else 2
+                if new_header[id_index] == -1:
+                    new_header[id_index] = self.geo().id_allocator().allocate()
+                new_id = int(new_header[4])
             else:
+                new_id = self.geo().id_allocator().allocate()
                 new_header = [metalization_level, len(xcoords), -1 if metal_type == "" else metal_type, 'N', new_id, 1, 1, 100, 100, 0, 0, 0, 'Y', tech_layer, inh]
 
             new_poly = [new_header, list(zip(xcoords, self.fix_y(ycoords)))]
@@ -172,12 +217,45 @@ class sonnetFile:
                 new_poly[1].append(new_poly[1][0])
                 new_poly[0][1] = new_poly[0][1] + 1
             polys.append(new_poly)
-            #print(polys)
-            self.son_dict = repack_geo(self.son_dict, polygons=polys)
             return new_id
 
+    def add_metal_polygons(self, metalization_level, polygons, metal_type="", tech_layer="", inherit=True):
+        if self.ml_backend:
+            return [self.add_metal_polygon(metalization_level, [float(x) for x, _ in p], [float(y) for _, y in p],
+                                           metal_type=metal_type, tech_layer=tech_layer, inherit=inherit) for p in polygons]
+
+        # Flip y and check which polygons are closed for the whole batch at once
+        _, yw = self.box_size()
+        if isinstance(polygons, np.ndarray) and polygons.ndim == 3:
+            coords = polygons.astype(float)
+            coords[:, :, 1] = yw - coords[:, :, 1]
+            closed = np.all(coords[:, 0] == coords[:, -1], axis=1).tolist()
+        else:
+            # Ragged list of (k, 2) coordinate arrays
+            closed = []
+            coords = []
+            for p in polygons:
+                c = np.array(p, dtype=float)
+                c[:, 1] = yw - c[:, 1]
+                closed.append(bool(np.all(c[0] == c[-1])))
+                coords.append(c)
+
+        ids = self.geo().id_allocator()
+        inh = "" if tech_layer == "" else ("INH" if inherit else "NOH")
+        new_ids = []
+        new_polys = []
+        for i in range(len(coords)):
+            new_id = ids.allocate()
+
+            # Handle when the user doesn't close the polygon
+            v = coords[i] if closed[i] else np.concatenate([coords[i], coords[i][:1]])
+            new_polys.append([[metalization_level, len(v), -1 if metal_type == "" else metal_type, 'N', new_id, 1, 1, 100, 100, 0, 0, 0, 'Y', tech_layer, inh], v])
+            new_ids.append(new_id)
+        self.geo().polygons.extend(new_polys)
+        return new_ids
+
     def set_refp(self, direction, refp_type, poly_id=None, vertex=None, rlength=None):
-        drp_list = extract_drp(self.son_dict)
+        drp_list = self.geo().drp
         refp_type_inner = refp_type.upper()
 
         set_drp_dict = {'type': refp_type_inner, 'direction': direction}
@@ -199,7 +277,11 @@ class sonnetFile:
                         set_drp_dict["vertex"] = drp["vertex"]
                 elif refp_type_inner == "FIX":
                     if rlength is not None:
-                        set_drp_dict["rlength"] = rlength
+                        set_drp_dict["length"] = rlength
+                    elif "length" in drp:
+                        set_drp_dict["length"] = drp["length"]
+                    else:
+                        raise Exception("rlength must be specified for new FIX reference plane.")
                 drp_list[drp_index] = set_drp_dict
                 break
             elif drp["direction"] == direction and refp_type_inner == "NONE":
@@ -217,239 +299,281 @@ class sonnetFile:
             elif refp_type_inner == "FIX":
                 if rlength is None:
                     raise Exception("rlength must be specified for new FIX reference plane.")
-                set_drp_dict["rlength"] = rlength
+                set_drp_dict["length"] = rlength
             drp_list.append(set_drp_dict)
-        self.son_dict = repack_geo(self.son_dict, drp=drp_list)
 
     def add_feedline(self, poly_id, vertex, direction="", perp_sign=None, port_number=None, res=50, react=0, ind=0, cap=0, metal_type=""):
-        direction_upper = direction.upper()
-        direction_internal = direction_upper
-        polygons = extract_polygons(self.son_dict)
-        poly = [p for p in polygons if int(p[0][4]) == poly_id][0]
-        tech_layer = poly[0][-2]
+        return self.add_feedlines([dict(poly_id=poly_id, vertex=vertex, direction=direction, perp_sign=perp_sign,
+                                        port_number=port_number, res=res, react=react, ind=ind, cap=cap,
+                                        metal_type=metal_type)])[0]
+
+    def add_feedlines(self, feedlines):
+        # Each feedline is a dict of add_feedline arguments or a (poly_id, vertex) pair. All edges are oriented at once
+        # and the polygons, ports and reference planes are added in one go. Returns the feedline ids.
+        if self.ml_backend:
+            raise Exception("This function is not supported in the Matlab backend.")
+        defaults = dict(direction="", perp_sign=None, port_number=None, res=50, react=0, ind=0, cap=0, metal_type="")
+        feeds = [{**defaults, **(dict(zip(("poly_id", "vertex"), f)) if isinstance(f, (tuple, list)) else f)}
+                 for f in feedlines]
+        if len(feeds) == 0:
+            return []
+        geo = self.geo()
+        polys = geo.polygons
         xw, yw = self.box_size()
-        poly = [[x, yw-y] for x,y in poly[1]]
-        poly_shape = ShapelyPolygon(poly)
-        xc = [poly[vertex+i][0] for i in range(2)]
-        yc = [poly[vertex+i][1] for i in range(2)]
-        match direction_upper:
-            case "":
-                xslope = xc[1] - xc[0]
-                yslope = yc[1] - yc[0]
-                midx = xc[0] + xslope / 2
-                midy = yc[0] + yslope / 2
-                perp = [- yslope, xslope]
-                perp_sign_internal = 1
-                if perp_sign is not None:
-                    perp_sign_internal = perp_sign
-                else:
-                    pscale = 1/100
-                    for i in range(10):
-                        check_x = midx + perp[0] * pscale
-                        check_y = midy + perp[1] * pscale
-                        inv_x = midx - perp[0] * pscale
-                        inv_y = midy - perp[1] * pscale
-                        if poly_shape.contains(Point(check_x, check_y)) and not poly_shape.contains(Point(inv_x, inv_y)):
-                            perp_sign_internal = -1
-                            break
-                        if poly_shape.contains(Point(inv_x, inv_y)) and not poly_shape.contains(Point(check_x, check_y)):
-                            perp_sign_internal = 1
-                            break
-                        pscale = pscale / 2
-                    else:
-                        raise Exception("Couldn't orient feedline (try setting perp_sign).")
-                perp = [perp[0] * perp_sign_internal, perp[1] * perp_sign_internal]
-                dx = None
-                dy = None
-                # Compute vertex 3
-                wall_0 = ""
-                if perp[0] != 0:
-                    dx = (xw - xc[1])/perp[0] if perp[0] > 0 else xc[1]/(-perp[0])
-                if perp[1] != 0:
-                    dy = (yw - yc[1])/perp[1] if perp[1] > 0 else yc[1]/(-perp[1])
-                if perp[0] == 0:
-                    dx = dy + 1
-                if perp[1] == 0:
-                    dy = dx + 1
-                if dx < dy:
-                    xc.append(xw if perp[0] > 0 else 0)
-                    yc.append(yc[1] + perp[1]*dx)
-                    wall_0 = "RIGHT" if perp[0] > 0 else "LEFT"
-                else:
-                    xc.append(xc[1] + perp[0]*dy)
-                    yc.append(yw if perp[1] > 0 else 0)
-                    wall_0 = "TOP" if perp[1] > 0 else "BOTTOM"
-
-                # Compute vertex 4
-                wall_1 = ""
-                if perp[0] != 0:
-                    dx = (xw - xc[0])/perp[0] if perp[0] > 0 else xc[0]/(-perp[0])
-                if perp[1] != 0:
-                    dy = (yw - yc[0])/perp[1] if perp[1] > 0 else yc[0]/(-perp[1])
-                if perp[0] == 0:
-                    dx = dy + 1
-                if perp[1] == 0:
-                    dy = dx + 1
-                if dx < dy:
-                    xc.append(xw if perp[0] > 0 else 0)
-                    yc.append(yc[0] + perp[1]*dx)
-                    wall_1 = "RIGHT" if perp[0] > 0 else "LEFT"
-                else:
-                    xc.append(xc[0] + perp[0]*dy)
-                    yc.append(yw if perp[1] > 0 else 0)
-                    wall_1 = "TOP" if perp[1] > 0 else "BOTTOM"
 
-                if wall_0 == wall_1:
-                    direction_internal = wall_0
-                else:
-                    warnings.warn("Feedline is not aligned with the walls of the polygon.")
-
-            case "TOP":
-                xc = xc + [poly[vertex+1][0], poly[vertex][0]]
-                yc = yc + [yw, yw]
-            case "BOTTOM":
-                xc = xc + [poly[vertex+1][0], poly[vertex][0]]
-                yc = yc + [0, 0]
-            case "LEFT":
-                xc = xc + [0, 0]
-                yc = yc + [poly[vertex+1][1], poly[vertex][1]]
-            case "RIGHT":
-                xc = xc + [xw, xw]
-                yc = yc + [poly[vertex+1][1], poly[vertex][1]]
-        xc.append(xc[0])
-        yc.append(yc[0])
-        feedline_id = self.add_metal_polygon(0, xc, yc, metal_type=metal_type, tech_layer=tech_layer)
-        self.add_std_port(feedline_id, 2, port_number=port_number, res=res, react=react, ind=ind, cap=cap)
-        if direction_internal != "":
-            self.set_refp(direction_internal, "LINK", poly_id=poly_id, vertex=vertex)
-        return feedline_id
-
-
-        
-        
-
-    def add_subcircuit(self, project, x, y):
+        # Edges in user coordinates
+        index = polys.find_all([f["poly_id"] for f in feeds])
+        rows = polys.edge_rows(index, [f["vertex"] for f in feeds])
+        p0 = polys.vertices[rows]
+        p1 = polys.vertices[rows+1]
+        p0[:, 1] = yw - p0[:, 1]
+        p1[:, 1] = yw - p1[:, 1]
+
+        # The inside of a counterclockwise polygon is left of every edge, so the winding order alone says which side
+        # is outside (the y flip makes file coordinates wind the other way)
+        edge = p1 - p0
+        perp = np.stack([-edge[:, 1], edge[:, 0]], axis=1)
+        area = -polys.signed_areas(index)
+        sign = np.where(area > 0, -1.0, 1.0)
+        for i in range(len(feeds)):
+            if feeds[i]["perp_sign"] is not None:
+                sign[i] = feeds[i]["perp_sign"]
+            elif feeds[i]["direction"] == "" and area[i] == 0:
+                raise Exception("Couldn't orient feedline (try setting perp_sign).")
+        perp = perp * sign[:, None]
+        end1, wall1 = wall_hits(p1, perp, xw, yw)
+        end0, wall0 = wall_hits(p0, perp, xw, yw)
+
+        coords = []
+        refps = []
+        for i in range(len(feeds)):
+            direction = feeds[i]["direction"].upper()
+            (x0, y0), (x1, y1) = p0[i].tolist(), p1[i].tolist()
+            match direction:
+                case "":
+                    xc = [x0, x1, *end1[i].tolist()[:1], *end0[i].tolist()[:1]]
+                    yc = [y0, y1, *end1[i].tolist()[1:], *end0[i].tolist()[1:]]
+                    if wall1[i] == wall0[i]:
+                        direction = str(wall1[i])
+                    else:
+                        warnings.warn("Feedline is not aligned with the walls of the polygon.")
+                case "TOP":
+                    xc, yc = [x0, x1, x1, x0], [y0, y1, yw, yw]
+                case "BOTTOM":
+                    xc, yc = [x0, x1, x1, x0], [y0, y1, 0, 0]
+                case "LEFT":
+                    xc, yc = [x0, x1, 0, 0], [y0, y1, y1, y0]
+                case "RIGHT":
+                    xc, yc = [x0, x1, xw, xw], [y0, y1, y1, y0]
+                case _:
+                    raise Exception(f"Unknown feedline direction {direction}.")
+            coords.append(np.array([xc + xc[:1], yc + yc[:1]], dtype=float).T)
+            if direction != "":
+                refps.append((direction, feeds[i]["poly_id"], feeds[i]["vertex"]))
+
+        # Polygons on the layer of the polygon they feed, then ports on their edge 2 and reference planes
+        ids = geo.id_allocator()
+        tech_layers = polys.headers["tech_layer"][index].tolist()
+        new_ids = []
+        new_polys = []
+        for i in range(len(feeds)):
+            new_id = ids.allocate()
+            v = coords[i].copy()
+            v[:, 1] = yw - v[:, 1]
+            metal_type = feeds[i]["metal_type"]
+            new_polys.append([[0, len(v), -1 if metal_type == "" else metal_type, 'N', new_id, 1, 1, 100, 100, 0, 0, 0, 'Y',
+                               tech_layers[i], "" if tech_layers[i] == "" else "INH"], v])
+            new_ids.append(new_id)
+        polys.extend(new_polys)
+        self.add_std_ports(new_ids, [2]*len(feeds), [f["port_number"] for f in feeds], *(
+            [f[key] for f in feeds] for key in ("res", "react", "ind", "cap")))
+        for direction, poly_id, vertex in refps:
+            self.set_refp(direction, "LINK", poly_id=poly_id, vertex=vertex)
+        return new_ids
+
+    def add_subcircuit(self, project, x=0, y=0, offsets=None):
         if self.ml_backend:
             raise Exception("This function is not supported in the Matlab backend.")
         else:
-            id_maps = []
-            polys = extract_polygons(project.son_dict)
-            _, yw = project.box_size()
-            for i in range(len(polys)):
-                if self.sonnet_version >= 18.53:
-                    old_id = polys[i][0][4]
-                    polys[i][0][4] = -1
-                else:
-                    old_id = polys[i][0][2]
-                    polys[i][0][2] = -1
-                for j in range(len(polys[i][1])):
-                    polys[i][1][j][0] = polys[i][1][j][0] + x
-                    polys[i][1][j][1] = (yw-polys[i][1][j][1]) + y
-                new_id = self.add_metal_polygon(0, *zip(*polys[i][1]), header=polys[i][0])
-                id_maps.append((int(old_id), new_id))
-        return id_maps
+            polys = project.geo().polygons
+            _, yw_src = project.box_size()
+            _, yw = self.box_size()
+
+            # All vertices of the subcircuit converted to user coordinates
+            coords = polys.vertices.copy()
+            coords[:, 1] = yw_src - coords[:, 1]
+            old_ids = polys.headers["id"].tolist()
+
+            ids = self.geo().id_allocator()
+            placed = polygonStore()
+            instance_maps = []
+            for dx, dy in (offsets if offsets is not None else [(x, y)]):
+                # Translate and flip into this project's coordinates
+                instance = polys.copy()
+                instance.vertices[:, 0] = coords[:, 0] + dx
+                instance.vertices[:, 1] = yw - (coords[:, 1] + dy)
+                new_ids = [ids.allocate() for _ in old_ids]
+                instance.headers["id"] = new_ids
+                placed.extend(instance)
+                instance_maps.append(list(zip(old_ids, new_ids)))
+
+            # Merge everything into the geometry at once
+            self.geo().polygons.extend(placed)
+        return instance_maps if offsets is not None else instance_maps[0]
 
     def set_valvar(self, name, value=None, vartype=None, Descr=None):
-        geo = self.son_dict["GEO"].split("\n")
-        for i in range(len(geo)):
-            if geo[i].startswith(f"VALVAR {name}"):
-                vv = geo[i].split(" ")
-                vv[2] = str(vartype) if vartype != None else vv[2]
-                vv[3] = str(value) if value != None else vv[3]
-                vv[4] = str(Descr) if Descr != None else vv[4]
-                geo[i] = " ".join(vv)
-                break
-        self.son_dict["GEO"] = "\n".join(geo)
+        valvars = self.geo().valvars
+        if name not in valvars:
+            # New variables need a type
+            if vartype is None:
+                raise Exception(f"Unknown VALVAR {name}.")
+            valvars[name] = {"type": str(vartype), "value": "0", "descr": ""}
+        valvar = valvars[name]
+        valvar["type"] = str(vartype) if vartype != None else valvar["type"]
+        valvar["value"] = str(value) if value != None else valvar["value"]
+        valvar["descr"] = str(Descr).strip('"') if Descr != None else valvar["descr"]
+
+    def set_valvars(self, values):
+        # Sets the values of several existing variables, {name: value}
+        valvars = self.geo().valvars
+        for name in values:
+            if name not in valvars:
+                raise Exception(f"Unknown VALVAR {name}.")
+        for name in values:
+            valvars[name]["value"] = str(values[name])
+
+    def get_valvar(self, name):
+        # Value of a variable, a number unless it is an expression
+        valvars = self.geo().valvars
+        if name not in valvars:
+            raise Exception(f"Unknown VALVAR {name}.")
+        try:
+            return parse_number(valvars[name]["value"])
+        except ValueError:
+            return valvars[name]["value"]
+
+    def list_valvars(self):
+        # Every variable as {"name", "type", "value", "descr"}, in file order
+        valvars = self.geo().valvars
+        return [{"name": name, **valvars[name]} for name in valvars]
+
+    def select(self, ids=None, level=None, tech_layer=None, bbox=None):
+        # Polygons matching all the given conditions, ids / level can be single values or lists and bbox is
+        # (x1, y1, x2, y2) in the coordinates of add_metal_polygon, polygons have to be entirely inside it
+        if self.ml_backend:
+            raise Exception("This function is not supported in the Matlab backend.")
+        polygons = self.geo().polygons
+        headers = polygons.headers
+        keep = np.ones(len(polygons), dtype=bool)
+        if ids is not None:
+            keep &= np.isin(headers["id"], np.atleast_1d(ids).astype(np.int64))
+        if level is not None:
+            keep &= np.isin(headers["level"], np.atleast_1d(level).astype(np.int32))
+        if tech_layer is not None:
+            keep &= np.isin(headers["tech_layer"].astype(str), np.atleast_1d(tech_layer).astype(str))
+        if bbox is not None:
+            _, yw = self.box_size()
+            x1, x2 = min(bbox[0], bbox[2]), max(bbox[0], bbox[2])
+            y1, y2 = yw - max(bbox[1], bbox[3]), yw - min(bbox[1], bbox[3])
+            bounds = polygons.bounds()
+            keep &= (bounds[:, 0] >= x1) & (bounds[:, 2] <= x2) & (bounds[:, 1] >= y1) & (bounds[:, 3] <= y2)
+        return polygonSelection(self, np.flatnonzero(keep))
 
     def delete_polygon(self, index):
         if self.ml_backend:
             raise Exception("This function is not supported in the Matlab backend.")
         else:
-            polys = extract_polygons(self.son_dict)
-            polys.pop(index)
-            self.son_dict = repack_geo(self.son_dict, polygons=polys)
+            self.geo().polygons.pop(index)
 
     def add_via_polygon(self, metalization_level, to_level, xcoords, ycoords):
         if not self.ml_backend:
             raise Exception("This function is not supported in the Python backend.")
-        xc = str(xcoords).replace(",", ";")
-        yc = str(self.fix_y(ycoords)).replace(",", ";")
-        self.eng.eval(f"Project.addViaPolygonEasy({metalization_level}, {to_level}, {xc}, {yc});", nargout=0)
+        xc = ml_vector(xcoords)
+        yc = f"{self.ml_var}.yBoxSize() - " + ml_vector(ycoords)
+        self.ml_eval(f"{self.ml_var}.addViaPolygonEasy({metalization_level}, {to_level}, {xc}, {yc});")
 
     def change_dielectric_layer_thickness(self, layer, thickness):
+        self.clear_box_cache()
         if self.ml_backend:
-            self.eng.eval(f"Project.changeDielectricLayerThickness({layer+1}, {thickness});", nargout=0)
+            self.ml_eval(f"{self.ml_var}.changeDielectricLayerThickness({layer+1}, {thickness});")
         else:
-            box = extract_box(self.son_dict)
-            box[1][layer][0] = thickness
-            self.son_dict = repack_geo(self.son_dict, box=box)
+            self.geo().box[1][layer][0] = thickness
 
     def add_std_port(self, polygon, vertex, port_number=None, res=50, react=0, ind=0, cap=0):
         if self.ml_backend:
-            self.eng.eval(f"Project.addPortToPolygon({polygon_number}, {port_number});", nargout=0)
+            args = f"{polygon}" if port_number is None else f"{polygon}, {port_number}"
+            self.ml_eval(f"{self.ml_var}.addPortToPolygon({args});")
         else:
-            v = [p for p in extract_polygons(self.son_dict) if int(p[0][4]) == polygon][0][1]
-            x = (v[vertex][0] + v[vertex+1][0])/2
-            y = (v[vertex][1] + v[vertex+1][1])/2
-
-            port_nums = list(map(lambda x: x["port_number"], extract_ports(self.son_dict)))
-            pn = 1 if len(port_nums) == 0 else max(port_nums)+1
-            pn = port_number if port_number is not None else pn
-            port_lines = []
-            if self.sonnet_version >= 18.53:
-                port_lines.append("POR1 BOX")
-            else:
-                port_lines.append("POR1 STD")
-            port_lines.append(f"POLY {polygon} 1")
-            port_lines.append(f"{vertex}")
-            port_lines.append(f"{pn} {res} {react} {ind} {cap} {x} {y}")
-
-            geo = [y for y in (x for x in self.son_dict["GEO"].splitlines()) if y]
-            port_indices = extract_ports(self.son_dict, indices=True)
-            final_port = 0
-            if len(port_indices) == 0:
-                polygons_start = [i for i in range(len(geo)) if "NUM" in geo[i]][0]
-                final_port = polygons_start-1
-            else:
-                final_port = max(port_indices)
-            geo = geo[:final_port+1] + port_lines + geo[final_port+1:]
-            self.son_dict["GEO"] = "\n".join(geo)
+            return self.add_std_ports([polygon], [vertex], None if port_number is None else [port_number], res, react, ind, cap)[0]
+
+    def add_std_ports(self, polygons, vertices, port_numbers=None, res=50, react=0, ind=0, cap=0):
+        # One port per (polygon id, vertex). Ports without a number (None) are numbered on from the highest port
+        # number, res / react / ind / cap can be one value or one per port. Returns the port numbers.
+        if self.ml_backend:
+            raise Exception("This function is not supported in the Matlab backend.")
+        geo = self.geo()
+        polygons = [int(p) for p in polygons]
+        vertices = [int(v) for v in vertices]
+        midpoints = geo.polygons.edge_midpoints(geo.polygons.find_all(polygons), vertices).tolist()
+        last = geo.ports.next_number() - 1
+        numbers = []
+        for pn in (port_numbers if port_numbers is not None else [None]*len(polygons)):
+            pn = last + 1 if pn is None else pn
+            last = max(last, pn)
+            numbers.append(pn)
+        res, react, ind, cap = [list(v) if isinstance(v, (list, tuple, np.ndarray)) else [v]*len(polygons)
+                                for v in (res, react, ind, cap)]
+        port_type = "BOX" if self.sonnet_version >= 18.53 else "STD"
+        geo.ports.extend({"type": port_type, "poly": polygons[i], "points": 1, "vertex": vertices[i],
+                          "port_number": numbers[i], "resistance": res[i], "reactance": react[i], "inductance": ind[i],
+                          "capacitance": cap[i], "x": midpoints[i][0], "y": midpoints[i][1]} for i in range(len(polygons)))
+        return numbers
 
     def change_box_size(self, x, y):
+        self.clear_box_cache()
         if self.ml_backend:
-            self.eng.eval(f"Project.changeBoxSize({x}, {y});", nargout=0)
+            self.ml_eval(f"{self.ml_var}.changeBoxSize({x}, {y});")
         else:
-            box = extract_box(self.son_dict)
+            box = self.geo().box
             box[0][1] = x
             box[0][2] = y
-            self.son_dict = repack_geo(self.son_dict, box=box)
 
     def change_cell_size(self, x, y):
+        self.clear_box_cache()
         if self.ml_backend:
-            self.eng.eval(f"Project.changeCellSizeUsingNumberOfCellsXY({x}, {y});", nargout=0)
+            self.ml_eval(f"{self.ml_var}.changeCellSizeUsingNumberOfCellsXY({x}, {y});")
         else:
-            box = extract_box(self.son_dict)
+            box = self.geo().box
             lenx, leny = box[0][1], box[0][2]
             box[0][3] = 2*int(lenx / x)
             box[0][4] = 2*int(leny / y)
-            self.son_dict = repack_geo(self.son_dict, box=box)
 
     def cell_size(self):
         if self.ml_backend:
             raise Exception("This function is not supported in the Matlab backend.")
-        else:
-            box = extract_box(self.son_dict)
-            return box[0][1]/(box[0][3]/2), box[0][2]/(box[0][4]/2)
+        if "cell" not in self.box_cache:
+            box = unpack_geo(self.son_dict).box
+            self.box_cache["cell"] = box[0][1]/(box[0][3]/2), box[0][2]/(box[0][4]/2)
+        return self.box_cache["cell"]
 
     def box_size(self):
+        if "size" in self.box_cache:
+            return self.box_cache["size"]
         if self.ml_backend:
-            x_size = self.eng.eval("Project.xBoxSize();")
-            y_size = self.eng.eval("Project.yBoxSize();")
+            if self.current_batch is not None:
+                self.current_batch.flush()
+            x_size, y_size = [float(v) for v in np.array(self.eng.eval(f"[{self.ml_var}.xBoxSize() {self.ml_var}.yBoxSize()];")).ravel()]
         else:
-            x_size = extract_box(self.son_dict)[0][1]
-            y_size = extract_box(self.son_dict)[0][2]
+            box = unpack_geo(self.son_dict).box
+            x_size = box[0][1]
+            y_size = box[0][2]
+        self.box_cache["size"] = x_size, y_size
         return x_size, y_size
 
+    def clear_box_cache(self):
+        # Call after changing the box or dielectric layers without the change_* methods
+        self.box_cache = {}
+
     def fix_y(self, yc):
         _, y_size = self.box_size()
         yco = [y_size - y for y in yc]
@@ -472,16 +596,14 @@ class sonnetFile:
             unpacked["FILEOUT"].append(f"MDIF D Y {fout} IC 8 S RI R 50.00000")
 
             # Repack the file and load changes into matlab
-            repack_son(self.file_name, unpacked)
-            self.reload()
+            self.repack(unpacked)
         else:
-            up = copy(self.son_dict)
             fout = ""
             if file_output == "":
                 fout = "$BASENAME.mdf"
             else:
                 fout = file_output
-            self.son_dict["FILEOUT"].append(f"MDIF D Y {fout} IC 8 S RI R 50.00000")
+            self.block("FILEOUT").append(f"MDIF D Y {fout} IC 8 S RI R 50.00000")
 
     def rm_mdif_output(self, file_output=""):
         if self.ml_backend:
@@ -500,8 +622,7 @@ class sonnetFile:
             unpacked["FILEOUT"] = [line for line in unpacked["FILEOUT"] if fout not in line]
 
             # Repack the file and load changes into matlab
-            repack_son(self.file_name, unpacked)
-            self.reload()
+            self.repack(unpacked)
         else:
             fout = ""
             if file_output == "":
@@ -512,7 +633,17 @@ class sonnetFile:
             self.son_dict["FILEOUT"] = [line for line in self.son_dict["FILEOUT"] if fout not in line]
 
 
-    def simulate_network(self, file_output=""):
+    def simulate_network(self, file_output="", cache=None):
+        if self.current_batch is not None:
+            raise Exception("Can't simulate inside a batch, the project is only saved when the batch ends.")
+        # Return the stored result if this exact project has been simulated before
+        key = None
+        if cache is not None:
+            key = cache.key(self)
+            out = cache.get(key)
+            if out is not None:
+                return out
+
         # If no file output is specified, use temp-0.mdf, unless temp-0.mdf exists in which case use temp-1.mdf
         i = 0
         fo = ""
@@ -544,12 +675,15 @@ class sonnetFile:
         out = None
         if good_output:
             # Load the results into skrf
-            out = rf.NetworkSet.from_mdif(fo)
+            out = read_mdif(fo).to_networkset()
 
         # Delete the temp file
         os.remove(fo)
         shutil.rmtree(f"sondata\\{os.path.splitext(self.file_name)[0]}")
 
+        if cache is not None:
+            cache.put(key, out)
+
         return out
 
     def sonnet_call_em(self, file_name="", options=""):
@@ -557,6 +691,46 @@ class sonnetFile:
             raise Exception("Can't call em, sonnet_path not set.")
         subprocess.call(f"{self.sonnet_path}em.exe {self.file_name}{'' if options == '' else ' '}{options}")
 
+    async def simulate_network_async(self, cache=None, timeout=None, progress=None, work_dir=None, keep_files=False):
+        if self.sonnet_path == "":
+            raise Exception("Can't call em, sonnet_path not set.")
+
+        # Snapshot the project so it can be edited while the simulation runs
+        unpacked = self.unpack() if self.ml_backend else self.son_dict
+        key = None
+        if cache is not None:
+            key = son_hash(unpacked)
+            out = cache.get(key)
+            if out is not None:
+                return out
+
+        job_dir, son_file, mdf_file = write_job(unpacked, self.file_name, work_dir)
+        try:
+            await run_async([f"{self.sonnet_path}em.exe", son_file], cwd=job_dir, timeout=timeout, progress=progress)
+            if not os.path.isfile(mdf_file):
+                raise Warning("Simulation failed.")
+
+            # Parse the results off the event loop
+            out = await asyncio.get_running_loop().run_in_executor(None, lambda: read_mdif(mdf_file).to_networkset())
+        finally:
+            if not keep_files:
+                shutil.rmtree(job_dir, ignore_errors=True)
+
+        if cache is not None:
+            cache.put(key, out)
+        return out
+
+    async def sonnet_call_em_async(self, file_name="", options="", timeout=None, progress=None):
+        if self.sonnet_path == "":
+            raise Exception("Can't call em, sonnet_path not set.")
+        file_name = file_name if file_name != "" else self.file_name
+        return await run_async([f"{self.sonnet_path}em.exe", file_name] + options.split(), timeout=timeout, progress=progress)
+
+    async def open_in_sonnet_async(self):
+        self.save()
+        await run_async([f"{self.sonnet_path}xgeom.exe", self.file_name])
+        self.reload()
+
     def targ_abs(self, resolution):
         if self.ml_backend:
             # Unpack the project
@@ -598,261 +772,1837 @@ class sonnetFile:
 
 
     def set_speed(self, speed):
-        # Unpacke the project
-        unpacked = self.unpack()
+        if self.ml_backend:
+            # Unpacke the project
+            unpacked = self.unpack()
 
-        # Replace the param SPEED in the bloc CONTROL with the new speed
-        self.repack(replace_param(unpacked, "CONTROL", "SPEED", speed))
+            # Replace the param SPEED in the bloc CONTROL with the new speed
+            self.repack(replace_param(unpacked, "CONTROL", "SPEED", speed))
+        else:
+            self.son_dict = replace_param(self.son_dict, "CONTROL", "SPEED", speed)
 
     def crop(self, x1, y1, x2, y2):
         if self.ml_backend:
             raise NotImplementedError("Cropping is not implemented for the matlab backend")
         else:
-            fix_ids = []
-            up = copy(self.son_dict)
-            polygons = extract_polygons(up)
-            poly_out = []
-            rect = ShapelyPolygon([[x1,y1],[x1,y2],[x2,y2],[x2,y1],[x1,y1]])
-            for p in polygons:
-                a = ShapelyPolygon(p[1]).intersection(rect)
+            poly_out, fix_ids = crop_polygons(self.geo().polygons, [(x1, y1, x2, y2)])[0]
 
-                if a.is_empty:
-                    continue
-                if isinstance(a,ShapelyMultiPolygon):
-                    multi_id = False
-                    for p1 in list(a.geoms):
-                        x = p1.exterior.coords.xy[0]
-                        y = p1.exterior.coords.xy[1]
-                        poly_out.append([p[0],list(map(lambda inp : [inp[0]-x1, inp[1]-y1], zip(x,y)))])
-                        if multi_id:
-                            fix_ids.append(len(poly_out)-1)
-                        else:
-                            multi_id = True
-                    continue
-                
-                x = a.exterior.coords.xy[0]
-                y = a.exterior.coords.xy[1]
-                poly_out.append([p[0],list(map(lambda inp : [inp[0]-x1, inp[1]-y1], zip(x,y)))])
-            for i in fix_ids:
-                poly_ids = [int(p[0][4]) for p in poly_out]
-                new_id = 1
-                while new_id in poly_ids:
-                    new_id = randint(2, len(poly_ids)*10)
-                poly_out[i][0][0] = new_id
             # Repack polygons
             self.son_dict = repack_geo(self.son_dict, polygons=poly_out)
 
+            # Pieces split off the same polygon need their own ids
+            geo = self.geo()
+            geo.raw_polygons = crop_raw_polygons(geo.raw_polygons, (x1, y1, x2, y2))
+            geo.raw_positions = []
+            ids = geo.id_allocator()
+            for i in fix_ids:
+                geo.polygons[i][0][4] = ids.allocate()
+
             # Change box boundaries
             cell_x, cell_y = self.cell_size()
             box_x, box_y = self.box_size()
             self.change_box_size(box_x, box_y)
             self.change_cell_size(cell_x, cell_y)
 
+    def crop_many(self, windows, file_names=None):
+        # Crop the project to each window (x1, y1, x2, y2) at once, returns a new project per window and leaves this one
+        # unchanged. Nothing is written to disk.
+        if self.ml_backend:
+            raise NotImplementedError("Cropping is not implemented for the matlab backend")
+        base = os.path.splitext(self.file_name)[0]
+        source = self.geo()
+        projects = []
+        for i, (poly_out, fix_ids) in enumerate(crop_polygons(source.polygons, windows)):
+            project = self.fork(file_names[i] if file_names is not None else f"{base}-{i+1}.son")
+            project.son_dict["GEO"] = source.copy(polygons=poly_out)
+            project.shared_blocks.pop("GEO").release()
+
+            geo = project.geo()
+            geo.raw_polygons = crop_raw_polygons(geo.raw_polygons, windows[i])
+            geo.raw_positions = []
+            ids = geo.id_allocator()
+            for j in fix_ids:
+                geo.polygons[j][0][4] = ids.allocate()
+            projects.append(project)
+        return projects
+
     def draw(self, figsize=(5,5), layer=None, metal_args=dict(color="#209fb5", edgecolor="#4c4f69", hatch="///"), 
              metal_argf = None, ports=True, 
-             port_box=dict(boxstyle="square", fc="#eff1f5", ec="#4c4f69", alpha=1), port_font_size=8):
-
-        draw_layer = layer
-        up = self.unpack() if self.ml_backend else self.son_dict
-        if layer is None:
-            if len([a[0][0] for a in extract_polygons(up)]) > 0:
-                ids =  [int(a[0][0]) for a in extract_polygons(up)]
-                draw_layer = max(ids)
-            else:
-                return plt.subplots(figsize=figsize)
+             port_box=dict(boxstyle="square", fc="#eff1f5", ec="#4c4f69", alpha=1), port_font_size=8, lod=False):
+
+        # Geometry is read once, straight from the parsed model
+        geo = unpack_geo(self.unpack()) if self.ml_backend else self.geo()
+        levels = geo.polygons.headers["level"]
+        draw_layers = select_levels(levels, layer)
+        if len(draw_layers) == 0:
+            return plt.subplots(figsize=figsize)
         # Get box size to handle coordinate shifts
         _,y = self.box_size()
         fig = plt.figure(figsize=figsize)
         ax = plt.axes()
-        polys0 = [a[1] for a in extract_polygons(up) if int(a[0][0]) == draw_layer]
-        poly_ids = [int(a[0][4]) for a in extract_polygons(up) if int(a[0][0]) == draw_layer]
-        poly_data = [a[0] for a in extract_polygons(up) if int(a[0][0]) == draw_layer]
-        polygons = [[[v[0], y-v[1]] for v in p] for p in polys0]
-
-        ports = []
-        if len(extract_ports(up)) > 0:
-            ports = [[a["port_number"],a["x"],y-a["y"]] for a in extract_ports(up) if a["poly"] in poly_ids]
-
-        for pind in range(len(polygons)):
-            if metal_argf is not None:
-                plt.fill(*zip(*polygons[pind]), **metal_argf(poly_data[pind]))
-            else:
-                plt.fill(*zip(*polygons[pind]), **metal_args)
 
-        for port in ports:
-            plt.text(port[1], port[2], port[0], bbox=port_box, clip_on=True, fontsize=port_font_size)
+        # Smallest feature that shows up as a pixel, used to skip polygons in level of detail mode
+        min_size = 0
+        if lod:
+            box_x, box_y = self.box_size()
+            min_size = max(box_x / (figsize[0]*fig.dpi), box_y / (figsize[1]*fig.dpi))
+
+        poly_ids = set()
+        for zorder, draw_layer in enumerate(draw_layers):
+            layer_polys = geo.polygons.take(np.flatnonzero(levels == draw_layer))
+            if len(layer_polys) == 0:
+                continue
+            poly_ids.update(layer_polys.headers["id"].tolist())
+            coords = layer_polys.vertices.copy()
+            coords[:, 1] = y - coords[:, 1]
+            starts = layer_polys.offsets[:-1]
+            keep = np.ones(len(layer_polys), dtype=bool)
+            if min_size > 0:
+                size_x = np.maximum.reduceat(coords[:, 0], starts) - np.minimum.reduceat(coords[:, 0], starts)
+                size_y = np.maximum.reduceat(coords[:, 1], starts) - np.minimum.reduceat(coords[:, 1], starts)
+                keep = (size_x >= min_size) | (size_y >= min_size)
+            verts = np.split(coords, starts[1:])
+
+            # One collection per distinct style
+            styles = {}
+            for pind in np.flatnonzero(keep):
+                args = metal_argf(layer_polys.header(pind)) if metal_argf is not None else metal_args
+                key = repr(sorted(args.items()))
+                if key not in styles:
+                    styles[key] = (args, [])
+                styles[key][1].append(verts[pind])
+            for args, style_verts in styles.values():
+                ax.add_collection(mpl_collections.PolyCollection(style_verts, zorder=1+zorder, **collection_args(args)))
+        ax.autoscale_view()
+
+        if ports:
+            for a in geo.ports:
+                if a["poly"] in poly_ids:
+                    plt.text(a["x"], y-a["y"], a["port_number"], bbox=port_box, clip_on=True, fontsize=port_font_size)
 
         return fig, ax
 
+    def render_raster(self, width, height, layer=None, file_name=""):
+        # Metal as a (height, width) uint8 image, 255 where there is metal, covering the box with the same y flip as draw
+        geo = unpack_geo(self.unpack()) if self.ml_backend else self.geo()
+        levels = geo.polygons.headers["level"]
+        draw_layers = select_levels(levels, layer)
+        box_x, box_y = self.box_size()
+        polygons = geo.polygons.take(np.flatnonzero(np.isin(levels, draw_layers)))
+        image = rasterize_polygons(polygons, width, height, width/box_x, height/box_y)
+        if file_name != "":
+            write_png(file_name, image)
+        return image
+
     def reload(self):
         if self.ml_backend:
             # Clear project variable
-            self.eng.eval("clear Project;", nargout=0)
+            self.eng.eval(f"clear {self.ml_var};", nargout=0)
 
             # Re-open the project
-            self.eng.eval(f"Project = SonnetProject(\"{self.file_name}\");", nargout=0) 
+            self.eng.eval(f"{self.ml_var} = SonnetProject(\"{self.file_name}\");", nargout=0) 
         else:
             self.son_dict = self.unpack()
+        self.clear_box_cache()
 
     def repack(self, unpacked):
+        if self.current_batch is not None:
+            # Written when the batch ends
+            self.current_batch.repack(unpacked)
+            return
         repack_son(self.file_name, unpacked)
         self.reload()
 
     def clean_project(self):
         if self.ml_backend:
-            self.eng.eval("Project.cleanProject();", nargout=0)
+            self.ml_eval(f"{self.ml_var}.cleanProject();")
 
     def clean_output_files(self):
         if self.ml_backend:
-            self.eng.eval("Project.cleanOutputFiles();", nargout=0)
+            self.ml_eval(f"{self.ml_var}.cleanOutputFiles();")
 
     def unpack(self):
+        if self.current_batch is not None:
+            return self.current_batch.unpacked()
         self.save()
         return unpack_son(self.file_name)
 
-def unpack_son(file_name):
-    # Open file_name and start reading its lines
-    with open(file_name, "r") as f:
-        lines = f.readlines()
-        # Create a dictionary to hold the different blocks
-        unpacked = {}
-        # Create a variable to hold the current block name
-        current_block = ""
-        # If header has not been reached yet leave this as true
-        pre_header = True
-        file_header = ""
-        # Loop through the lines
-        for line in lines:
-            # If the line is equal to header set pre_header to false
-            if line == "HEADER\n":
-                pre_header = False
-            # If the line is equal to END current_block\n set current_block to ""
-            elif line == f"END {current_block}\n":
-                current_block = ""
-                continue
+    def ml_eval(self, code):
+        # Matlab backend calls without a result, queued while a batch is open
+        if self.current_batch is not None:
+            self.current_batch.lines.append(code)
+        else:
+            self.eng.eval(code, nargout=0)
+
+    def batch(self):
+        return editBatch(self)
+
+    def geo(self):
+        unpack_geo(self.son_dict)
+        return self.block("GEO")
+
+    def block(self, name):
+        # Block of son_dict that can be changed in place, copied first if a fork still holds it
+        shared = self.shared_blocks.pop(name, None)
+        if shared is not None and shared.release():
+            value = self.son_dict[name]
+            self.son_dict[name] = value.fork() if isinstance(value, sonnetGeo) else list(value)
+        return self.son_dict[name]
+
+    def share_blocks(self):
+        # Copy of son_dict sharing the parsed blocks of this one, and the sharedValues for it to hold them with
+        for block in self.son_dict:
+            # Text blocks can't be changed in place and don't need copying
+            if not isinstance(self.son_dict[block], str):
+                self.shared_blocks[block] = self.shared_blocks.get(block, sharedValue()).share()
+        return dict(self.son_dict), dict(self.shared_blocks)
+
+    def fork(self, file_name=""):
+        # New project sharing the parsed blocks of this one. A block is copied by a project that changes it while
+        # another one still holds it, the last one holding it changes it in place. Nothing is written to disk until
+        # the fork is saved or simulated.
+        if self.ml_backend:
+            raise Exception("This function is not supported in the Matlab backend.")
+        if file_name == "":
+            while True:
+                self.fork_count = self.fork_count + 1
+                file_name = os.path.splitext(self.file_name)[0] + f"-{self.fork_count}.son"
+                if not os.path.exists(file_name):
+                    break
+        project = copy(self)
+        project.temp = False
+        project.current_batch = None
+        project.fork_count = 0
+        project.box_cache = dict(self.box_cache)
+        project.file_name = file_name
+        project.son_dict, project.shared_blocks = self.share_blocks()
+        return project
+
+    def seed_ids(self, seed):
+        # New polygon ids count up from seed
+        geo = self.geo()
+        geo.id_seed = seed
+        geo.ids = None
+
+def rasterize_polygons(polygons, width, height, scale_x, scale_y):
+    # Scanline fill of the union of polygons (lists of [x, y] vertices, closed or not) into a (height, width) uint8
+    # image. Sonnet's y axis points down, so row 0 is y = 0. A pixel is filled when its center is inside.
+    image = np.zeros((height, width), dtype=np.uint8)
+    if isinstance(polygons, polygonStore):
+        coords, counts = polygon_arrays(polygons.take(np.flatnonzero(polygons.counts() > 2)))
+    else:
+        polygons = [p for p in polygons if len(p) > 2]
+        counts = np.array([len(p) for p in polygons], dtype=np.int64)
+        coords = np.array([v for p in polygons for v in p], dtype=float).reshape(-1, 2)
+    if len(counts) == 0:
+        return image
+    coords = coords * [scale_x, scale_y]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    # Edges from each vertex to the next one of its polygon
+    nxt = np.arange(1, len(coords) + 1)
+    nxt[starts + counts - 1] = starts
+    x0, y0 = coords[:, 0], coords[:, 1]
+    x1, y1 = coords[nxt, 0], coords[nxt, 1]
+
+    # Turn every polygon the same way so overlapping polygons add up instead of cancelling
+    area = np.add.reduceat(x0*y1 - x1*y0, starts)
+    direction = np.where(y1 > y0, 1, -1) * np.repeat(np.where(area < 0, -1, 1), counts)
+
+    # Rows whose center line each edge crosses
+    row_start = np.clip(np.ceil(np.minimum(y0, y1) - 0.5), 0, height).astype(int)
+    row_end = np.clip(np.ceil(np.maximum(y0, y1) - 0.5), 0, height).astype(int)
+    crossings = np.maximum(row_end - row_start, 0)
+    edge = np.repeat(np.arange(len(coords)), crossings)
+    rows = np.arange(crossings.sum()) - np.repeat(np.cumsum(crossings) - crossings, crossings) + row_start[edge]
+    yc = rows + 0.5
+    xc = x0[edge] + (yc - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
+    cols = np.clip(np.ceil(xc - 0.5), 0, width).astype(int)
+
+    # Winding number changes at each crossing, summed along the rows
+    winding = np.zeros((height, width + 1), dtype=np.int32)
+    np.add.at(winding, (rows, cols), direction[edge])
+    image[np.cumsum(winding, axis=1)[:, :width] != 0] = 255
+    return image
+
+def write_png(file_name, image):
+    # Writes a (height, width) uint8 array as a grayscale PNG
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    height, width = image.shape
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    # Each row starts with filter type 0 (none)
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), image], axis=1).tobytes()
+    with open(file_name, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw, 6)))
+        f.write(chunk(b"IEND", b""))
+
+def select_levels(levels, layer):
+    # Levels to draw for the layer argument of draw / render_raster: the top level with metal when None, else one
+    # level or a list of them
+    if layer is None:
+        return [int(levels.max())] if len(levels) > 0 else []
+    if isinstance(layer, (list, tuple, range, np.ndarray)):
+        return [int(l) for l in layer]
+    return [int(layer)]
+
+def collection_args(args):
+    # plt.fill style arguments to PolyCollection ones, color only fills in whichever of face / edge color isn't given
+    args = dict(args)
+    if "color" in args:
+        color = args.pop("color")
+        args.setdefault("facecolor", color)
+        args.setdefault("edgecolor", color)
+    return args
+
+class sharedValue:
+    # Number of holders of a value shared by fork(). A holder that changes the value copies it first unless it is the
+    # last one holding it, so of two holders only one ever copies.
+    def __init__(self):
+        self.holders = 1
+
+    def share(self):
+        self.holders = self.holders + 1
+        return self
+
+    def release(self):
+        # True if others still hold the value
+        self.holders = self.holders - 1
+        return self.holders > 0
+
+class editBatch:
+    # Edits made inside "with project.batch():" are kept in memory and the file is written once when the block ends.
+    # Matlab backend calls are queued and sent to MATLAB as one eval script, ids of polygons added in the batch are in
+    # batch.ids afterwards. If the block raises, the in-memory edits are rolled back.
+    def __init__(self, project):
+        self.project = project
+        self.lines = []
+        self.ids = []
+        self.new_ids = 0
+        self.tech_layers = []
+        self.save_as = None
+        # Matlab backend: project as last read from / to be written to the file
+        self.son_dict = None
+        self.dirty = False
+        # Python backend: son_dict and shared blocks to go back to, sharing the blocks the batch doesn't change
+        self.snapshot = None
+
+    def __enter__(self):
+        if self.project.current_batch is not None:
+            raise Exception("A batch is already open for this project.")
+        if not self.project.ml_backend:
+            self.snapshot = self.project.share_blocks()
+        self.project.current_batch = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.project.current_batch = None
+        if exc_type is None:
+            self.commit()
+        elif self.project.ml_backend:
+            # Drop what hasn't reached MATLAB yet
+            self.lines = []
+            self.son_dict = None
+            self.project.clear_box_cache()
+        else:
+            release_blocks(self.project.son_dict, self.project.shared_blocks)
+            self.project.son_dict, self.project.shared_blocks = self.snapshot
+            self.project.clear_box_cache()
+
+    def add_polygon(self, add, tech_layer, inherit):
+        self.lines.append(f"{self.project.ml_var}_ids(end+1) = {add};")
+        if tech_layer != "":
+            self.tech_layers.append((len(self.ids) + self.new_ids, tech_layer, "INH" if inherit else "NOH"))
+        self.new_ids = self.new_ids + 1
+
+    def unpacked(self):
+        # Matlab backend project as a son_dict, only read from the file again when MATLAB has changed it
+        project = self.project
+        if not project.ml_backend:
+            return project.son_dict
+        if self.son_dict is None or len(self.lines) > 0:
+            self.flush()
+            project.ml_save(project.file_name)
+            self.son_dict = unpack_son(project.file_name)
+        return self.son_dict
+
+    def repack(self, unpacked):
+        if self.project.ml_backend:
+            self.son_dict = unpacked
+            self.dirty = True
+        else:
+            self.project.son_dict = unpacked
+        self.project.clear_box_cache()
+
+    def flush(self):
+        # Brings MATLAB up to date: writes in-memory edits and runs what has been queued so far in one eval
+        project = self.project
+        if self.dirty:
+            repack_son(project.file_name, self.son_dict)
+            project.reload()
+            self.dirty = False
+        if len(self.lines) == 0:
+            return
+        project.eng.eval("\n".join([f"{project.ml_var}_ids = [];"] + self.lines), nargout=0)
+        if self.new_ids > 0:
+            self.ids += [int(i) for i in np.array(project.eng.workspace[f"{project.ml_var}_ids"]).ravel()]
+        self.lines = []
+        self.new_ids = 0
+        self.son_dict = None
+
+    def commit(self):
+        project = self.project
+        if not project.ml_backend:
+            project.save(self.save_as if self.save_as is not None else "")
+            release_blocks(*self.snapshot)
+            return
+
+        queued = len(self.lines) > 0
+        self.flush()
+        if queued or self.save_as is not None:
+            project.ml_save(self.save_as if self.save_as is not None else project.file_name)
+
+        # Tech layers of new polygons, all in one file round trip
+        if len(self.tech_layers) > 0:
+            unpacked = unpack_son(project.file_name)
+            polygons = {int(p[0][4]): p for p in unpack_geo(unpacked).polygons}
+            for i, tech_layer, inherit in self.tech_layers:
+                polygons[self.ids[i]][0][-2:] = [tech_layer, inherit]
+            repack_son(project.file_name, unpacked)
+            project.reload()
+
+def release_blocks(son_dict, shared_blocks):
+    # Drops a son_dict, letting go of its shared blocks and of the polygons of a GEO block nobody else holds
+    for block, value in son_dict.items():
+        if block in shared_blocks and shared_blocks[block].release():
+            continue
+        if isinstance(value, sonnetGeo) and value.shared_polygons is not None:
+            value.shared_polygons.release()
+            value.shared_polygons = None
+
+class portTable:
+    # Ports of a GEO block in file order, in the extract_ports format, indexed by port number and by polygon id.
+    # Several ports can share a number. Call reindex() after changing port_number or poly of a port in place.
+    def __init__(self, ports=()):
+        self.ports = []
+        self.numbers = {}
+        self.polys = {}
+        self.extend(ports)
 
-            # If pre_header is false and current_block="" then set current_block to the line
-            if not pre_header and current_block == "":
-                current_block = line.strip()
-                if current_block != "GEO":
-                    unpacked[current_block] = []
+    def __len__(self):
+        return len(self.ports)
+
+    def __iter__(self):
+        return iter(self.ports)
+
+    def __getitem__(self, index):
+        return self.ports[index]
+
+    def __repr__(self):
+        return repr(self.ports)
+
+    def add_index(self, port):
+        self.numbers.setdefault(port["port_number"], []).append(port)
+        self.polys.setdefault(port["poly"], []).append(port)
+
+    def append(self, port):
+        self.ports.append(port)
+        self.add_index(port)
+
+    def extend(self, ports):
+        for port in ports:
+            self.append(port)
+
+    def remove(self, port):
+        # Removes this port dict (by identity, ports can be equal)
+        self.ports = [p for p in self.ports if p is not port]
+        self.numbers[port["port_number"]] = [p for p in self.numbers[port["port_number"]] if p is not port]
+        self.polys[port["poly"]] = [p for p in self.polys[port["poly"]] if p is not port]
+
+    def by_number(self, port_number):
+        return list(self.numbers.get(port_number, []))
+
+    def by_poly(self, poly_id):
+        return list(self.polys.get(int(poly_id), []))
+
+    def next_number(self):
+        numbers = [n for n in self.numbers if len(self.numbers[n]) > 0]
+        return 1 if len(numbers) == 0 else max(numbers)+1
+
+    def reindex(self):
+        ports = self.ports
+        self.ports, self.numbers, self.polys = [], {}, {}
+        self.extend(ports)
+
+class idAllocator:
+    # Hands out unused polygon ids by counting up from seed, so the same edits always give the same ids
+    def __init__(self, used=(), seed=1):
+        self.used = set(used)
+        self.next_id = seed
+
+    def allocate(self):
+        while self.next_id in self.used:
+            self.next_id = self.next_id + 1
+        new_id = self.next_id
+        self.used.add(new_id)
+        self.next_id = self.next_id + 1
+        return new_id
+
+# Markers standing in for the parsed sections inside sonnetGeo.lines
+geo_box_marker = "\0BOX"
+geo_drp_marker = "\0DRP1"
+geo_port_marker = "\0POR1"
+geo_valvar_marker = "\0VALVAR"
+
+class sonnetGeo:
+    # Parsed GEO block. Lines that aren't understood are kept verbatim in self.lines, the box, reference planes,
+    # ports and polygons are kept in the same formats as extract_box, extract_drp, extract_ports and extract_polygons.
+    def __init__(self, geo=""):
+        # geo is the text of the block or a list of its lines
+        self.lines = []
+        self.box = None
+        self.drp = []
+        self.ports = portTable()
+        # VALVAR name -> {"type", "value", "descr"}, in file order
+        self.valvars = {}
+        # sharedValue of the polygon store while a fork holds it too
+        self.shared_polygons = None
+        self.polygons = polygonStore()
+        # Vias, bricks and anything else in the polygon section that isn't a plain metal polygon
+        self.raw_polygons = []
+        # Number of metal polygons before each raw entry in the file, so they are written back in place
+        self.raw_positions = []
+        # Polygon id allocator, built on first use
+        self.ids = None
+        self.id_seed = 1
+        if len(geo) > 0:
+            self.parse(geo)
+
+    def parse(self, geo):
+        g_lines = [x for x in (geo.splitlines() if isinstance(geo, str) else geo) if x.strip()]
+        num = len(g_lines)
+        for i in range(len(g_lines)):
+            if g_lines[i].split()[0] == "NUM":
+                num = i
+                break
+
+        # Everything before NUM
+        i = 0
+        while i < num:
+            split = g_lines[i].split()
+            if split[0] == "BOX" and self.box is None:
+                box_end = i+1
+                while box_end < num and g_lines[box_end][:1] in (" ", "\t"):
+                    box_end = box_end + 1
+                self.box = parse_box(g_lines[i:box_end])
+                self.lines.append(geo_box_marker)
+                i = box_end
+            elif split[0] == "DRP1" and len(split) > 2 and split[2] in ("LINK", "FIX"):
+                if geo_drp_marker not in self.lines:
+                    self.lines.append(geo_drp_marker)
+                if split[2] == "LINK":
+                    self.drp.append({"type": "LINK", "direction": split[1], "poly_id": int(g_lines[i+1].split()[1]),
+                                     "vertex": int(g_lines[i+2].split()[0])})
+                    i = i+3
                 else:
-                    unpacked[current_block] = ""
-            elif not pre_header and not current_block == "GEO":
-                unpacked[current_block].append(line.strip())
-            elif not pre_header:
-                # Leave all geometry information untouched
-                unpacked[current_block] += line
+                    self.drp.append({"type": "FIX", "direction": split[1], "length": float(split[3])})
+                    i = i+1
+            elif split[0] == "POR1":
+                if geo_port_marker not in self.lines:
+                    self.lines.append(geo_port_marker)
+                port, i = parse_port(g_lines, i)
+                self.ports.append(port)
+            elif split[0] == "VALVAR" and len(split) > 3:
+                # Repeated VALVAR lines (a SonnetLab bug) end up as one entry
+                if geo_valvar_marker not in self.lines:
+                    self.lines.append(geo_valvar_marker)
+                name, valvar = parse_valvar(g_lines[i])
+                self.valvars[name] = valvar
+                i = i+1
             else:
-                file_header += line
-    unpacked["file_header"] = file_header
-    return unpacked
+                self.lines.append(g_lines[i])
+                i = i+1
+
+        # Polygons, each one is terminated by END
+        polygons = []
+        chunk = []
+        for line in g_lines[num+1:]:
+            line = line.strip()
+            if line != "END":
+                chunk.append(line)
+                continue
+            polygon = parse_polygon(chunk)
+            if polygon is None:
+                self.raw_polygons.append(chunk)
+                self.raw_positions.append(len(polygons))
+            else:
+                polygons.append(polygon)
+            chunk = []
+        if len(chunk) > 0:
+            self.raw_polygons.append(chunk)
+            self.raw_positions.append(len(polygons))
+        self.polygons = polygonStore(polygons)
+
+    @property
+    def ports(self):
+        return self.port_table
+
+    @ports.setter
+    def ports(self, ports):
+        # Lists of port dicts are indexed into a portTable
+        self.port_table = ports if isinstance(ports, portTable) else portTable(ports)
+
+    @property
+    def polygons(self):
+        # A store a fork still holds is copied before it can be changed
+        if self.shared_polygons is not None:
+            if self.shared_polygons.release():
+                self.polygon_store = self.polygon_store.copy()
+            self.shared_polygons = None
+        self.polygon_store.allocator = self.ids
+        return self.polygon_store
+
+    @polygons.setter
+    def polygons(self, polygons):
+        # Lists of [header, vertices] are packed into a polygonStore
+        self.polygon_store = polygons if isinstance(polygons, polygonStore) else polygonStore(polygons)
+        if self.shared_polygons is not None:
+            self.shared_polygons.release()
+            self.shared_polygons = None
+        # Ids are collected again from the new polygons
+        self.ids = None
+
+    def id_allocator(self):
+        if self.ids is None:
+            used = self.polygon_store.headers["id"].tolist()
+            for chunk in self.raw_polygons:
+                header = [line.split() for line in chunk if len(line.split()) > 3]
+                if len(header) > 0 and header[0][4].lstrip("-").isdigit():
+                    used.append(int(header[0][4]))
+            self.ids = idAllocator(used, self.id_seed)
+        if self.shared_polygons is None:
+            self.polygon_store.allocator = self.ids
+        return self.ids
+
+    def iter_lines(self):
+        # Lines of the block one at a time, so large layouts can be written without building them all first
+        for line in self.lines:
+            if line == geo_box_marker:
+                yield from box_lines(self.box)
+            elif line == geo_drp_marker:
+                yield from drp_lines(self.drp)
+            elif line == geo_port_marker:
+                for port in self.ports:
+                    yield from port_lines(port)
+            elif line == geo_valvar_marker:
+                for name in self.valvars:
+                    yield valvar_line(name, self.valvars[name])
+            else:
+                yield line
+
+        # Reference planes / ports that were added to a file that had none
+        if geo_drp_marker not in self.lines:
+            yield from drp_lines(self.drp)
+        if geo_port_marker not in self.lines:
+            for port in self.ports:
+                yield from port_lines(port)
+        if geo_valvar_marker not in self.lines:
+            for name in self.valvars:
+                yield valvar_line(name, self.valvars[name])
+
+        yield "NUM " + str(len(self.polygon_store) + len(self.raw_polygons))
+        # Raw entries go back between the metal polygons they were read between, ones added later go last
+        count = len(self.polygon_store)
+        start = 0
+        for i in range(len(self.raw_polygons)):
+            position = self.raw_positions[i] if i < len(self.raw_positions) else count
+            position = max(start, min(position, count))
+            yield from self.polygon_store.iter_lines(start, position)
+            yield from self.raw_polygons[i]
+            yield "END"
+            start = position
+        yield from self.polygon_store.iter_lines(start, count)
+
+    def to_lines(self):
+        return list(self.iter_lines())
+
+    def __str__(self):
+        return "\n".join(self.to_lines()) + "\n"
+
+    def __copy__(self):
+        # A shallow copy holds the polygon store too
+        geo = sonnetGeo.__new__(sonnetGeo)
+        geo.__dict__.update(self.__dict__)
+        if self.shared_polygons is not None:
+            geo.shared_polygons = self.shared_polygons.share()
+        return geo
+
+    def copy(self, polygons=None):
+        # Independent copy, with polygons replaced by the given list if there is one
+        geo = copy(self)
+        geo.lines = list(self.lines)
+        geo.box = deepcopy(self.box)
+        geo.drp = deepcopy(self.drp)
+        geo.ports = deepcopy(self.ports)
+        geo.valvars = deepcopy(self.valvars)
+        geo.raw_polygons = [list(chunk) for chunk in self.raw_polygons]
+        geo.raw_positions = list(self.raw_positions)
+        geo.polygons = self.polygon_store.copy() if polygons is None else polygonStore(polygons)
+        geo.ids = None
+        return geo
+
+    def fork(self):
+        # Copy that shares the polygon store, only copied by a geo changing its polygons while the other holds them
+        geo = self.copy(polygons=[])
+        geo.polygon_store = self.polygon_store
+        if self.shared_polygons is None:
+            self.shared_polygons = sharedValue()
+        geo.shared_polygons = self.shared_polygons.share()
+        return geo
+
+def crop_polygons(polygons, windows):
+    # For each window (x1, y1, x2, y2) returns the polygons cut to the window and moved so its corner is the origin,
+    # and the indices of the extra pieces of polygons that were split (which still share their original id).
+    if len(polygons) == 0:
+        return [([], []) for _ in windows]
+
+    # All polygons as shapely geometries in one go, with a spatial index so each window only cuts nearby ones
+    coords, counts = polygon_arrays(polygons)
+    shapes = shapely.polygons(shapely.linearrings(coords, indices=np.repeat(np.arange(len(polygons)), counts)))
+    tree = shapely.STRtree(shapes)
+
+    out = []
+    for x1, y1, x2, y2 in windows:
+        rect = shapely.box(min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+        candidates = np.sort(tree.query(rect, predicate="intersects"))
+        pieces = shapely.intersection(shapes[candidates], rect)
+
+        # Split multipolygons and drop anything that isn't an area (edges / corners touching the window)
+        parts, part_index = shapely.get_parts(pieces, return_index=True)
+        keep = (shapely.get_type_id(parts) == 3) & (shapely.area(parts) > 0)
+        parts, part_index = parts[keep], part_index[keep]
+        rings = shapely.get_exterior_ring(parts)
+        ends = np.cumsum(shapely.get_num_coordinates(rings)).tolist()
+        vertices = (shapely.get_coordinates(rings) - [x1, y1]).tolist()
+
+        poly_out = []
+        fix_ids = []
+        last = -1
+        start = 0
+        for i in range(len(parts)):
+            header = list(polygons[candidates[part_index[i]]][0])
+            header[1] = str(ends[i] - start)
+            poly_out.append([header, vertices[start:ends[i]]])
+            if part_index[i] == last:
+                fix_ids.append(len(poly_out)-1)
+            last = part_index[i]
+            start = ends[i]
+        out.append((poly_out, fix_ids))
+    return out
+
+def crop_raw_polygons(raw_polygons, window):
+    # Vias, bricks and other raw entries moved like crop_polygons moves metal. They aren't cut, the ones that aren't
+    # entirely inside the window are dropped.
+    x1, y1, x2, y2 = window
+    out = []
+    for chunk in raw_polygons:
+        rows = []
+        coords = []
+        for i in range(1, len(chunk)):
+            split = chunk[i].split()
+            if len(split) != 2:
+                continue
+            try:
+                coords.append([float(split[0]), float(split[1])])
+            except ValueError:
+                continue
+            rows.append(i)
+        coords = np.array(coords, dtype=float).reshape(-1, 2)
+        inside = (coords[:, 0] >= min(x1, x2)) & (coords[:, 0] <= max(x1, x2)) \
+            & (coords[:, 1] >= min(y1, y2)) & (coords[:, 1] <= max(y1, y2))
+        if not np.all(inside):
+            continue
+        chunk = list(chunk)
+        for i, (x, y) in zip(rows, (coords - [x1, y1]).tolist()):
+            chunk[i] = f"{format_number(x)} {format_number(y)}"
+        out.append(chunk)
+    return out
+
+def unpack_geo(unpacked):
+    # GEO is only parsed once, dicts built by hand (see new_son) may still hold the raw text
+    if not isinstance(unpacked["GEO"], sonnetGeo):
+        unpacked["GEO"] = sonnetGeo(unpacked["GEO"])
+    return unpacked["GEO"]
+
+def parse_number(s):
+    try:
+        return int(s)
+    except ValueError:
+        return float(s)
+
+def parse_token(s):
+    # Numbers are parsed, anything else (like the A of an anisotropic layer) is kept as it is
+    try:
+        return parse_number(s)
+    except ValueError:
+        return s
+
+def parse_box(lines):
+    geo_box = lines[0].split()[1:]
+    geo_box[0:6] = list(map(parse_number, geo_box[0:6]))
+    geo_box[6] = float(geo_box[6])
+    layers = []
+    for line in lines[1:]:
+        # Layer names are quoted and may contain spaces
+        pre, name, post = line.strip().split("\"", 2)
+        layer = pre.split()
+        layer[0:6] = list(map(float, layer[0:6]))
+        layer[6] = int(layer[6])
+        layers.append(layer + [name] + list(map(parse_token, post.split())))
+    return [geo_box, layers]
+
+def box_lines(box):
+    if box is None:
+        return []
+    box[0][0] = len(box[1])-1
+    lines = ["BOX " + ' '.join(map(format_number, box[0]))]
+    for layer in box[1]:
+        line = '      ' + ' '.join(map(format_number, layer[0:7])) + ' "' + layer[7] + '"'
+        if len(layer) > 8:
+            line = line + ' ' + ' '.join(map(format_number, layer[8:]))
+        lines.append(line)
+    return lines
+
+def parse_port(g_lines, i):
+    # Returns the port starting at line i and the index of the line after it
+    split = g_lines[i].split()
+    port = {"type": split[1]}
+    if split[1] == "CUP":
+        port["calib_group"] = split[2]
+    split = g_lines[i+1].split()
+    port["poly"] = int(split[1])
+    port["points"] = int(split[2])
+    port["vertex"] = int(g_lines[i+2].split()[0])
+    split = g_lines[i+3].split()
+    port["port_number"] = int(split[0])
+    port["resistance"] = float(split[1])
+    port["reactance"] = float(split[2])
+    port["inductance"] = float(split[3])
+    port["capacitance"] = float(split[4])
+    port["x"] = float(split[5])
+    port["y"] = float(split[6])
+    if port["type"] == "AGND":
+        if len(split) < 9:
+            port["agnd_calib_type"] = "NONE"
+        else:
+            port["agnd_calib_type"] = split[7]
+            port["agnd_plane_length"] = split[8]
+            if len(split) == 10:
+                port["agnd_calib_length"] = split[9]
+    i = i+4
+    if port["type"] == "CUP":
+        while i < len(g_lines):
+            split = g_lines[i].split()
+            if split[0] == "CUPGRP":
+                port["cup_group"] = split[1]
+                port["cup_group_type"] = split[2]
+            elif split[0] == "ID":
+                port["cup_id"] = int(split[1])
+            elif split[0] == "GRNDREF":
+                port["cup_grndref"] = split[1]
+            elif split[0] == "TWTYPE":
+                port["cup_twtype"] = split[1]
+            else:
+                break
+            i = i+1
+    return port, i
+
+def port_lines(port):
+    lines = ["POR1 " + port["type"] + (" " + port["calib_group"] if port["type"] == "CUP" else ""),
+             f"POLY {port['poly']} {port.get('points', 1)}",
+             f"{port['vertex']}"]
+    line = ' '.join(format_number(port[key]) for key in ("port_number", "resistance", "reactance", "inductance", "capacitance", "x", "y"))
+    if port["type"] == "AGND" and port.get("agnd_calib_type", "NONE") != "NONE":
+        line = line + f" {port['agnd_calib_type']} {port['agnd_plane_length']}"
+        if "agnd_calib_length" in port:
+            line = line + f" {port['agnd_calib_length']}"
+    lines.append(line)
+    if port["type"] == "CUP":
+        if "cup_group" in port:
+            lines.append(f"CUPGRP {port['cup_group']} {port['cup_group_type']}")
+        if "cup_id" in port:
+            lines.append(f"ID {port['cup_id']}")
+        if "cup_grndref" in port:
+            lines.append(f"GRNDREF {port['cup_grndref']}")
+        if "cup_twtype" in port:
+            lines.append(f"TWTYPE {port['cup_twtype']}")
+    return lines
+
+def parse_valvar(line):
+    # VALVAR <name> <type> <value> "<description>", the value can be an expression
+    _, name, vartype, rest = line.strip().split(" ", 3)
+    value, quote, descr = rest.partition(' "')
+    return name, {"type": vartype, "value": value, "descr": descr[:-1] if quote != "" else None}
+
+def valvar_line(name, valvar):
+    line = f"VALVAR {name} {valvar['type']} {valvar['value']}"
+    return line if valvar["descr"] is None else line + f' "{valvar["descr"]}"'
+
+def drp_lines(drp):
+    lines = []
+    for d in drp:
+        if d["type"] == "LINK":
+            lines = lines + [f"DRP1 {d['direction']} LINK", f"POLY {d['poly_id']} 1", f"{d['vertex']}"]
+        elif d["type"] == "FIX":
+            lines.append(f"DRP1 {d['direction']} FIX {format_number(d['length'])}")
+    return lines
+
+def parse_polygon(chunk):
+    # Returns None for anything that isn't a plain metal polygon (vias, bricks, ...)
+    header = chunk[0].split() if len(chunk) > 0 else []
+    if len(header) <= 3:
+        return None
+    tech_layer = ["", ""]
+    vertices = []
+    for line in chunk[1:]:
+        split = line.split()
+        if split[0] == "TLAYNAM" and len(vertices) == 0:
+            tech_layer = (line[8:].strip().rsplit(" ", 1) + [""])[:2]
+        elif len(split) == 2:
+            try:
+                vertices.append([float(split[0]), float(split[1])])
+            except ValueError:
+                return None
+        else:
+            return None
+    return [header + tech_layer, vertices]
+
+def format_number(value):
+    # Whole numbers are written without ".0", the way Sonnet writes them
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def ml_vector(values):
+    # Coordinates [a,b,c,d] as the MATLAB column [a;b;c;d], through float so NumPy scalars don't print as np.float64(a)
+    return str([float(v) for v in values]).replace(",", ";")
+
+# Polygon header fields kept as columns, the ones in between the id and the tech layer are kept as strings in "fields"
+polygon_dtype = np.dtype([("level", np.int32), ("metal", np.int32), ("fill", object), ("id", np.int64),
+                          ("fields", object), ("tech_layer", object), ("inherit", object)])
+
+class polygonStore:
+    # Metal polygons of a GEO block. Vertices of all polygons are rows of one float64 array, polygon i being
+    # vertices[offsets[i]:offsets[i+1]], and headers are a structured array. Items are polygonViews, which behave
+    # like the [header, vertices] lists of extract_polygons, so code written against lists keeps working.
+    def __init__(self, polygons=()):
+        self.size = 0
+        self.vertex_count = 0
+        # Buffers with room to grow, only the first size / vertex_count entries are used
+        self.vertex_buffer = np.empty((0, 2), dtype=np.float64)
+        self.offset_buffer = np.zeros(1, dtype=np.int64)
+        self.header_buffer = np.empty(0, dtype=polygon_dtype)
+        # idAllocator of the sonnetGeo holding this store, told about every id that is added
+        self.allocator = None
+        self.extend(polygons)
+
+    @property
+    def vertices(self):
+        return self.vertex_buffer[:self.vertex_count]
+
+    @property
+    def offsets(self):
+        return self.offset_buffer[:self.size+1]
+
+    @property
+    def headers(self):
+        return self.header_buffer[:self.size]
+
+    def counts(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [polygonView(self, i) for i in range(*index.indices(self.size))]
+        return polygonView(self, self.check_index(index))
+
+    def __setitem__(self, index, polygon):
+        index = self.check_index(index)
+        self.set_header(index, polygon[0])
+        self.set_vertices(index, polygon[1])
+
+    def __delitem__(self, index):
+        self.pop(index)
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield polygonView(self, i)
+
+    def __repr__(self):
+        return f"polygonStore({self.size} polygons, {self.vertex_count} vertices)"
+
+    def check_index(self, index):
+        index = int(index)
+        if index < 0:
+            index = index + self.size
+        if index < 0 or index >= self.size:
+            raise IndexError("polygon index out of range")
+        return index
+
+    def reserve(self, polygons, vertices):
+        # Grow the buffers to fit this many more polygons / vertices, doubling so appends stay cheap
+        if self.size + polygons > len(self.header_buffer):
+            capacity = max(self.size + polygons, 2*len(self.header_buffer), 16)
+            headers = np.empty(capacity, dtype=polygon_dtype)
+            headers[:self.size] = self.headers
+            offsets = np.zeros(capacity+1, dtype=np.int64)
+            offsets[:self.size+1] = self.offsets
+            self.header_buffer, self.offset_buffer = headers, offsets
+        if self.vertex_count + vertices > len(self.vertex_buffer):
+            capacity = max(self.vertex_count + vertices, 2*len(self.vertex_buffer), 64)
+            buffer = np.empty((capacity, 2), dtype=np.float64)
+            buffer[:self.vertex_count] = self.vertices
+            self.vertex_buffer = buffer
+
+    def append(self, polygon):
+        self.extend([polygon])
+
+    def extend(self, polygons):
+        if isinstance(polygons, polygonStore):
+            headers, coords, counts = polygons.headers.copy(), polygons.vertices, polygons.counts()
+        else:
+            polygons = list(polygons)
+            if len(polygons) == 0:
+                return
+            headers = np.array([header_record(p[0]) for p in polygons], dtype=polygon_dtype)
+            verts = [np.asarray(p[1], dtype=np.float64).reshape(-1, 2) for p in polygons]
+            counts = np.array([len(v) for v in verts], dtype=np.int64)
+            coords = np.concatenate(verts)
+        self.reserve(len(headers), len(coords))
+        self.header_buffer[self.size:self.size+len(headers)] = headers
+        self.vertex_buffer[self.vertex_count:self.vertex_count+len(coords)] = coords
+        self.offset_buffer[self.size+1:self.size+len(headers)+1] = self.vertex_count + np.cumsum(counts)
+        self.size = self.size + len(headers)
+        self.vertex_count = self.vertex_count + len(coords)
+        if self.allocator is not None:
+            self.allocator.used.update(headers["id"].tolist())
+
+    def insert(self, index, polygon):
+        index = min(max(index + self.size if index < 0 else index, 0), self.size)
+        tail = self.take(np.arange(index, self.size))
+        self.truncate(index)
+        self.append(polygon)
+        self.extend(tail)
+
+    def pop(self, index=-1):
+        index = self.check_index(index)
+        out = [self.header(index), self.vertex_view(index).tolist()]
+        self.delete([index])
+        return out
 
-def extract_polygons(unpacked):
-    # Extract the lines relevant to polygons
-    g_lines = [y for y in (x.strip() for x in unpacked["GEO"].splitlines()) if y]
-    polygons_start = [i for i in range(len(g_lines)) if "NUM" in g_lines[i]][0]
-    polygon_lines = g_lines[polygons_start+1:]
+    def delete(self, indices):
+        # Removes several polygons in one pass
+        keep = np.ones(self.size, dtype=bool)
+        keep[np.asarray(indices, dtype=np.int64)] = False
+        kept = self.take(np.flatnonzero(keep))
+        self.truncate(0)
+        self.extend(kept)
+
+    def take(self, indices):
+        # New store with the given polygons, in the given order
+        indices = np.asarray(indices, dtype=np.int64)
+        out = polygonStore()
+        counts = self.counts()[indices]
+        rows = self.vertex_rows(indices)
+        out.reserve(len(indices), len(rows))
+        out.header_buffer[:len(indices)] = self.headers[indices]
+        out.vertex_buffer[:len(rows)] = self.vertices[rows]
+        out.offset_buffer[1:len(indices)+1] = np.cumsum(counts)
+        out.size, out.vertex_count = len(indices), len(rows)
+        return out
 
-    if(len(polygon_lines) == 0):
-        return []
+    def vertex_rows(self, indices):
+        # Rows of vertices belonging to the given polygons, in order
+        indices = np.asarray(indices, dtype=np.int64)
+        counts = self.counts()[indices]
+        starts = self.offsets[:-1][indices]
+        return np.repeat(starts - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts) + np.arange(counts.sum())
+
+    def bounds(self):
+        # (n, 4) array of min x, min y, max x, max y of each polygon
+        if self.size == 0:
+            return np.empty((0, 4))
+        starts = self.offsets[:-1]
+        return np.hstack([np.minimum.reduceat(self.vertices, starts), np.maximum.reduceat(self.vertices, starts)])
+
+    def truncate(self, size):
+        self.vertex_count = int(self.offset_buffer[size])
+        self.size = size
+
+    def copy(self):
+        return self.take(np.arange(self.size))
+
+    def header(self, index):
+        return header_list(self.header_buffer[index].item(), int(self.offset_buffer[index+1] - self.offset_buffer[index]))
+
+    def find(self, poly_id):
+        # Index of the polygon with this id
+        found = np.flatnonzero(self.headers["id"] == int(poly_id))
+        if len(found) == 0:
+            raise IndexError(f"No polygon with id {poly_id}")
+        return int(found[0])
+
+    def signed_areas(self, indices=None):
+        # Shoelace area of each polygon (closed, first vertex repeated), or of the given ones, positive when
+        # counterclockwise
+        if indices is not None:
+            return self.take(indices).signed_areas()
+        if self.size == 0:
+            return np.empty(0)
+        v = self.vertices
+        cross = np.zeros(len(v))
+        cross[:-1] = v[:-1, 0]*v[1:, 1] - v[1:, 0]*v[:-1, 1]
+        cross[self.offsets[1:]-1] = 0
+        return np.add.reduceat(cross, self.offsets[:-1]) / 2
+
+    def find_all(self, poly_ids):
+        # Indices of the polygons with these ids, in one pass
+        ids = self.headers["id"]
+        poly_ids = np.asarray(poly_ids, dtype=np.int64)
+        if len(ids) == 0:
+            found, missing = poly_ids, poly_ids
+        else:
+            order = np.argsort(ids, kind="stable")
+            found = order[np.minimum(np.searchsorted(ids[order], poly_ids), len(ids)-1)]
+            missing = poly_ids[ids[found] != poly_ids]
+        if len(missing) > 0:
+            raise IndexError(f"No polygon with id {missing[0]}")
+        return found
+
+    def edge_rows(self, indices, vertices):
+        # Rows of the first vertex of the edge from vertex to vertex+1 of each polygon
+        indices = np.asarray(indices, dtype=np.int64)
+        vertices = np.asarray(vertices, dtype=np.int64)
+        bad = (vertices < 0) | (vertices + 1 >= self.counts()[indices])
+        if np.any(bad):
+            raise IndexError(f"No edge after vertex {vertices[bad][0]} in polygon {self.headers['id'][indices[bad][0]]}")
+        return self.offsets[:-1][indices] + vertices
+
+    def edge_midpoints(self, indices, vertices):
+        # Middle of the edge from vertex to vertex+1 of each polygon, where ports sit
+        rows = self.edge_rows(indices, vertices)
+        return (self.vertices[rows] + self.vertices[rows+1]) / 2
+
+    def set_header(self, index, header):
+        self.header_buffer[index] = header_record(header)
+        if self.allocator is not None:
+            self.allocator.used.add(int(self.header_buffer[index]["id"]))
+
+    def vertex_view(self, index):
+        return self.vertex_buffer[self.offset_buffer[index]:self.offset_buffer[index+1]]
+
+    def set_vertices(self, index, vertices):
+        vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+        if len(vertices) == self.offset_buffer[index+1] - self.offset_buffer[index]:
+            self.vertex_view(index)[:] = vertices
+        else:
+            header = self.header(index)
+            tail = self.take(np.arange(index+1, self.size))
+            self.truncate(index)
+            self.append([header, vertices])
+            self.extend(tail)
+
+    def tolist(self):
+        # Same format as extract_polygons
+        vertices = self.vertices.tolist()
+        offsets = self.offsets.tolist()
+        headers = self.headers.tolist()
+        return [[header_list(headers[i], offsets[i+1] - offsets[i]), vertices[offsets[i]:offsets[i+1]]]
+                for i in range(self.size)]
+
+    def iter_lines(self, start=0, stop=None):
+        # Lines of polygons start to stop (header, TLAYNAM when there is a tech layer, vertices and END), formatting
+        # their vertices in one go
+        stop = self.size if stop is None else stop
+        offsets = self.offsets[start:stop+1].tolist()
+        if len(offsets) < 2:
+            return
+        vertex_lines = [f"{format_number(x)} {format_number(y)}" for x, y in self.vertices[offsets[0]:offsets[-1]].tolist()]
+        headers = self.headers[start:stop].tolist()
+        for i in range(stop - start):
+            header = header_list(headers[i], offsets[i+1] - offsets[i])
+            yield ' '.join(map(str, header[:-2]))
+            if header[-2] != "":
+                yield "TLAYNAM " + ' '.join(map(str, header[-2:]))
+            yield from vertex_lines[offsets[i]-offsets[0]:offsets[i+1]-offsets[0]]
+            yield "END"
+
+class polygonSelection:
+    # Polygons of a project picked by project.select(). Transforms run on all selected vertices at once, in the
+    # coordinates of add_metal_polygon (origin at the bottom left of the box, y up). Indices go stale if polygons
+    # are added or removed, select again after that.
+    def __init__(self, project, indices):
+        self.project = project
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def ids(self):
+        return self.project.geo().polygons.headers["id"][self.indices].tolist()
+
+    def coordinates(self):
+        # Copy of the selected vertices, stacked
+        polygons = self.project.geo().polygons
+        coords = polygons.vertices[polygons.vertex_rows(self.indices)]
+        coords[:, 1] = self.project.box_size()[1] - coords[:, 1]
+        return coords
+
+    def set_coordinates(self, coords):
+        geo = self.project.geo()
+        rows = geo.polygons.vertex_rows(self.indices)
+        geo.polygons.vertices[rows, 0] = coords[:, 0]
+        geo.polygons.vertices[rows, 1] = self.project.box_size()[1] - coords[:, 1]
+
+        # Ports sit in the middle of an edge of their polygon and move with it
+        moved = [port for poly_id in set(self.ids()) for port in geo.ports.by_poly(poly_id)]
+        if len(moved) > 0:
+            midpoints = geo.polygons.edge_midpoints(geo.polygons.find_all([port["poly"] for port in moved]),
+                                                    [port["vertex"] for port in moved]).tolist()
+            for port, (x, y) in zip(moved, midpoints):
+                port["x"] = x
+                port["y"] = y
+
+    def center(self):
+        # Center of the bounding box of the selection
+        coords = self.coordinates()
+        return (coords.min(axis=0) + coords.max(axis=0)) / 2
+
+    def transform(self, matrix, origin=None, offset=(0, 0)):
+        # Applies the 2x2 matrix around origin (default the center of the selection), then moves by offset
+        if len(self.indices) == 0:
+            return self
+        coords = self.coordinates()
+        origin = self.center() if origin is None else np.asarray(origin, dtype=float)
+        self.set_coordinates((coords - origin) @ np.asarray(matrix, dtype=float).T + origin + offset)
+        return self
+
+    def translate(self, dx, dy):
+        return self.transform(np.eye(2), origin=(0, 0), offset=(dx, dy))
+
+    def rotate(self, angle, origin=None):
+        # Counterclockwise, in degrees
+        a = np.radians(angle)
+        return self.transform([[np.cos(a), -np.sin(a)], [np.sin(a), np.cos(a)]], origin=origin)
+
+    def mirror(self, axis="y", origin=None):
+        # axis="y" mirrors left / right across a vertical line through origin, axis="x" top / bottom
+        return self.transform(np.diag([-1, 1] if axis.lower() == "y" else [1, -1]), origin=origin)
+
+    def scale(self, factor, origin=None):
+        # factor is one number or (x factor, y factor)
+        return self.transform(np.diag(np.broadcast_to(np.asarray(factor, dtype=float), (2,))), origin=origin)
+
+    def snap_to_grid(self, cell=None):
+        # Rounds the selected vertices to the project's cell grid, or to cell = (x, y)
+        cell_x, cell_y = self.project.cell_size() if cell is None else cell
+        geo = self.project.geo()
+        rows = geo.polygons.vertex_rows(self.indices)
+        coords = geo.polygons.vertices[rows]
+        coords = np.round(coords / [cell_x, cell_y]) * [cell_x, cell_y]
+        coords[:, 1] = self.project.box_size()[1] - coords[:, 1]
+        self.set_coordinates(coords)
+        return self
+
+def header_list(record, count):
+    level, metal, fill, poly_id, fields, tech_layer, inherit = record
+    return [level, count, metal, fill, poly_id] + list(fields) + [tech_layer, inherit]
+
+def header_record(header):
+    header = list(header)
+    return (int(header[0]), int(header[2]), str(header[3]), int(header[4]), tuple(str(f) for f in header[5:-2]),
+            str(header[-2]), str(header[-1]))
+
+class polygonView:
+    # One polygon of a polygonStore, polygon[0] is its header and polygon[1] its vertices as an (n, 2) array. Both
+    # write through to the store.
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __len__(self):
+        return 2
+
+    def __getitem__(self, item):
+        if item == 0 or item == -2:
+            return headerView(self.store, self.index)
+        elif item == 1 or item == -1:
+            return self.store.vertex_view(self.index)
+        raise IndexError("polygon index out of range")
+
+    def __setitem__(self, item, value):
+        if item == 0 or item == -2:
+            self.store.set_header(self.index, value)
+        elif item == 1 or item == -1:
+            self.store.set_vertices(self.index, value)
+        else:
+            raise IndexError("polygon index out of range")
+
+    def __iter__(self):
+        yield self[0]
+        yield self[1]
+
+    def __eq__(self, other):
+        return [list(self[0]), self[1].tolist()] == [list(other[0]), [list(v) for v in other[1]]]
+
+    def __repr__(self):
+        return repr([list(self[0]), self[1].tolist()])
+
+class headerView:
+    # Header of one polygon of a polygonStore, reads and writes like the header list of extract_polygons
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __len__(self):
+        return 7 + len(self.store.header_buffer[self.index]["fields"])
+
+    def __getitem__(self, item):
+        return self.store.header(self.index)[item]
+
+    def __setitem__(self, item, value):
+        header = self.store.header(self.index)
+        header[item] = value
+        self.store.set_header(self.index, header)
+
+    def __iter__(self):
+        return iter(self.store.header(self.index))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(self.store.header(self.index))
+
+def wall_hits(points, directions, xw, yw):
+    # Where rays from points along directions leave the box (0, 0) - (xw, yw), and the wall each one crosses
+    x, y = points[:, 0], points[:, 1]
+    dx, dy = directions[:, 0], directions[:, 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tx = np.where(dx > 0, (xw - x)/dx, np.where(dx < 0, x/-dx, np.inf))
+        ty = np.where(dy > 0, (yw - y)/dy, np.where(dy < 0, y/-dy, np.inf))
+        side = tx < ty
+        hits = np.where(side[:, None], np.stack([np.where(dx > 0, xw, 0), y + dy*tx], axis=1),
+                        np.stack([x + dx*ty, np.where(dy > 0, yw, 0)], axis=1))
+    walls = np.where(side, np.where(dx > 0, "RIGHT", "LEFT"), np.where(dy > 0, "TOP", "BOTTOM"))
+    return hits, walls
+
+def polygon_arrays(polygons):
+    # Vertices of all polygons stacked and the number of vertices of each, for a polygonStore or a list of polygons
+    if isinstance(polygons, polygonStore):
+        return polygons.vertices, polygons.counts()
+    counts = np.array([len(p[1]) for p in polygons], dtype=np.int64)
+    coords = np.array([v for p in polygons for v in p[1]], dtype=float).reshape(-1, 2)
+    return coords, counts
+
+class simulationPool:
+    # Runs em on many projects at once. Every job gets a copy of its project in its own directory so the output
+    # files and sondata folders of simultaneous runs can't collide.
+    def __init__(self, workers=None, work_dir=None, options="", keep_files=False, cache=None):
+        # em does the work in its own process, so threads are enough to keep several running
+        self.executor = ThreadPoolExecutor(max_workers=workers if workers is not None else os.cpu_count())
+        self.work_dir = work_dir
+        self.options = options
+        self.keep_files = keep_files
+        self.cache = cache
+
+    def submit(self, project):
+        if project.sonnet_path == "":
+            raise Exception("Can't call em, sonnet_path not set.")
+
+        # Write a snapshot of the project now, so it can keep being edited while the job runs
+        unpacked = project.unpack() if project.ml_backend else project.son_dict
+
+        key = None
+        if self.cache is not None:
+            key = son_hash(unpacked, self.options)
+            out = self.cache.get(key)
+            if out is not None:
+                future = Future()
+                future.set_result(out)
+                return future
+
+        job_dir, son_file, mdf_file = write_job(unpacked, project.file_name, self.work_dir)
+        command = [f"{project.sonnet_path}em.exe", son_file] + self.options.split()
+        return self.executor.submit(self.run_job, command, job_dir, mdf_file, key)
+
+    def map(self, projects):
+        return [self.submit(project) for project in projects]
+
+    def run_job(self, command, job_dir, mdf_file, key=None):
+        try:
+            subprocess.run(command, cwd=job_dir)
+            if not os.path.isfile(mdf_file):
+                raise Warning("Simulation failed.")
+            out = read_mdif(mdf_file).to_networkset()
+            if key is not None:
+                # The simulation worked, a result that can't be cached is still returned
+                try:
+                    self.cache.put(key, out)
+                except (OSError, pickle.PicklingError) as e:
+                    warnings.warn(f"Could not cache simulation result: {e}")
+            return out
+        finally:
+            if not self.keep_files:
+                shutil.rmtree(job_dir, ignore_errors=True)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+class parameterSweep:
+    # Variants of a template project over a grid (or list) of parameter values. Parameters are VALVAR names,
+    # "box_x", "box_y" (keeping the cell size) or "thickness_<layer>" for dielectric layer thicknesses.
+    def __init__(self, template, params, grid=True):
+        self.template = open_son(template) if isinstance(template, str) else template
+        if self.template.ml_backend:
+            raise Exception("This function is not supported in the Matlab backend.")
+        self.names = list(params)
+        self.grid = grid
+        for name in self.names:
+            if not is_sweep_param(self.template, name):
+                raise Exception(f"Unknown sweep parameter {name}.")
+
+        values = [list(params[name]) for name in self.names]
+        self.coords = dict(zip(self.names, values))
+        if grid:
+            self.shape = tuple(map(len, values))
+            self.points = list(itertools.product(*values))
+        else:
+            if len(set(map(len, values))) > 1:
+                raise Exception("All parameter lists must have the same length when grid=False.")
+            self.shape = (len(values[0]),)
+            self.points = list(zip(*values))
+
+    def variant(self, values):
+        # New project in memory, nothing is written to disk until it is simulated
+        project = self.template.fork()
+        for name in values:
+            set_sweep_param(project, name, values[name])
+        return project
+
+    def variants(self):
+        for point in self.points:
+            yield self.variant(dict(zip(self.names, point)))
+
+    def run(self, workers=None, cache=None, options=""):
+        networks = np.empty(len(self.points), dtype=object)
+        errors = {}
+        with simulationPool(workers=workers, cache=cache, options=options) as pool:
+            # Variants are made one at a time as they are handed to the pool
+            futures = [pool.submit(v) for v in self.variants()]
+            for i in range(len(futures)):
+                try:
+                    networks[i] = futures[i].result()
+                except Exception as e:
+                    errors[self.points[i]] = e
+        return sweepResult(self, networks.reshape(self.shape), errors)
+
+class sweepResult:
+    # Results of a parameterSweep. networks has one axis per parameter (or a single axis for grid=False) and holds
+    # the NetworkSet of each variant, None where the simulation failed (see errors).
+    def __init__(self, sweep, networks, errors):
+        self.names = sweep.names
+        self.coords = sweep.coords
+        self.points = sweep.points
+        self.grid = sweep.grid
+        self.networks = networks
+        self.errors = errors
+
+    def sel(self, **values):
+        if self.grid:
+            index = tuple(self.coords[n].index(values[n]) if n in values else slice(None) for n in self.names)
+            return self.networks[index]
+        matches = [i for i in range(len(self.points))
+                   if all(self.points[i][self.names.index(n)] == values[n] for n in values)]
+        return self.networks[matches[0]] if len(matches) == 1 else self.networks[matches]
+
+    def first_network(self):
+        # Any successful variant, for the frequencies / shape shared by all of them
+        for n in self.networks.flat:
+            if n is not None:
+                return n
+        failures = "\n".join(f"  {point}: {error!r}" for point, error in self.errors.items())
+        raise Exception(f"Every variant of the sweep failed:\n{failures}")
+
+    def frequency(self, index=0):
+        return self.first_network()[index].f
+
+    def s(self, index=0):
+        # S parameters of network index of every variant in one array shaped (*networks.shape, freq, port, port),
+        # NaN for failed variants
+        first = self.first_network()[index].s
+        out = np.full(self.networks.shape + first.shape, np.nan, dtype=complex)
+        for i in np.ndindex(self.networks.shape):
+            if self.networks[i] is not None:
+                out[i] = self.networks[i][index].s
+        return out
 
-    pind = -1
-    polygons = []
-    subheader = False
-    via = False
-    for li in range(len(polygon_lines)):
-        # If the line has more than 3 spaces or is equal to "VIA POLYGON" it is a new polygon
-        split = polygon_lines[li].split()
-        if len(split) > 3 and not via:
-            polygons.append([split, []])
-            pind += 1
-            subheader = False
-            via = False
-        elif via:
+def is_sweep_param(project, name):
+    if name in ("box_x", "box_y"):
+        return True
+    if name.startswith("thickness_"):
+        return name[10:].isdigit() and int(name[10:]) < len(project.geo().box[1])
+    return name in unpack_geo(project.son_dict).valvars
+
+def set_sweep_param(project, name, value):
+    if name in ("box_x", "box_y"):
+        cell_x, cell_y = project.cell_size()
+        box_x, box_y = project.box_size()
+        project.change_box_size(value if name == "box_x" else box_x, value if name == "box_y" else box_y)
+        project.change_cell_size(cell_x, cell_y)
+    elif name.startswith("thickness_"):
+        project.change_dielectric_layer_thickness(int(name[10:]), value)
+    else:
+        project.set_valvar(name, value)
+
+def write_job(unpacked, file_name, work_dir=None):
+    # Write a copy of a project with an MDIF output into its own directory, returns the directory, .son and .mdf paths
+    job_dir = tempfile.mkdtemp(prefix="pyson-", dir=work_dir)
+    base = os.path.splitext(os.path.basename(file_name))[0]
+    son_file = os.path.join(job_dir, base + ".son")
+    mdf_file = os.path.join(job_dir, base + ".mdf")
+    up = copy(unpacked)
+    up["FILEOUT"] = unpacked["FILEOUT"] + [f"MDIF D Y {base}.mdf IC 8 S RI R 50.00000"]
+    repack_son(son_file, up)
+    return job_dir, son_file, mdf_file
+
+async def run_async(command, cwd=None, timeout=None, progress=None):
+    # Run a Sonnet program without blocking the event loop, each line it prints is passed to progress. The program
+    # is killed if the timeout runs out or the awaiting task is cancelled.
+    process = await asyncio.create_subprocess_exec(*command, cwd=cwd, stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.STDOUT)
+
+    async def read_output():
+        async for line in process.stdout:
+            if progress is not None:
+                progress(line.decode(errors="replace").rstrip())
+        return await process.wait()
+
+    try:
+        return await asyncio.wait_for(read_output(), timeout)
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+
+def simulate_networks(projects, workers=None, options="", cache=None):
+    # Start simulating all projects and return a future for each NetworkSet
+    pool = simulationPool(workers=workers, options=options, cache=cache)
+    futures = pool.map(projects)
+    pool.shutdown(wait=False)
+    return futures
+
+class simulationCache:
+    # On-disk store of simulation results keyed by son_hash. The networks of each result are pickled (NetworkSet
+    # itself can't be), when the total size goes over max_size the least recently used results are removed.
+    def __init__(self, cache_dir="pyson_cache", max_size=2**30):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, project, options=""):
+        return son_hash(project.unpack() if project.ml_backend else project.son_dict, options)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".pkl")
+
+    def get(self, key):
+        try:
+            with open(self.path(key), "rb") as f:
+                networks, name = pickle.load(f)
+            # Mark as recently used
+            os.utime(self.path(key))
+            return rf.NetworkSet(networks, name=name)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def put(self, key, networks):
+        # Write to a temporary name first so readers never see half a file
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump((list(networks), networks.name), f)
+        os.replace(temp_path, self.path(key))
+        self.evict()
+
+    def invalidate(self, key):
+        if os.path.isfile(self.path(key)):
+            os.remove(self.path(key))
+
+    def clear(self):
+        for entry in os.listdir(self.cache_dir):
+            if entry.endswith(".pkl"):
+                os.remove(os.path.join(self.cache_dir, entry))
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".pkl"):
+                # Another writer may have removed it since the listing
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total = total - size
+
+mdif_units = {"HZ": 1.0, "KHZ": 1e3, "MHZ": 1e6, "GHZ": 1e9}
+
+class mdifData:
+    # S parameters of an MDIF file as written by em. All blocks share one frequency array and one S parameter array
+    # (rows of every block one after another), block i is rows offsets[i]:offsets[i+1]. skrf objects are only made
+    # when asked for.
+    def __init__(self, f, s, offsets, params, z0=50.0, unit="ghz"):
+        self.f = f
+        self.s = s
+        self.offsets = offsets
+        self.params = params
+        self.z0 = z0
+        self.unit = unit
+
+    def __len__(self):
+        return len(self.params)
+
+    def block(self, i):
+        # Views into the shared arrays, nothing is copied
+        return self.f[self.offsets[i]:self.offsets[i+1]], self.s[self.offsets[i]:self.offsets[i+1]]
+
+    def network(self, i):
+        f, s = self.block(i)
+        frequency = rf.Frequency.from_f(np.array(f) / mdif_units[self.unit.upper()], unit=self.unit)
+        ntwk = rf.Network(frequency=frequency, s=np.array(s), z0=self.z0)
+        ntwk.params = dict(self.params[i])
+        return ntwk
+
+    def to_networkset(self):
+        return rf.NetworkSet([self.network(i) for i in range(len(self))])
+
+    def save(self, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(os.path.join(cache_dir, "f.npy"), self.f)
+        np.save(os.path.join(cache_dir, "s.npy"), self.s)
+        np.save(os.path.join(cache_dir, "offsets.npy"), self.offsets)
+        with open(os.path.join(cache_dir, "params.json"), "w") as f:
+            json.dump({"params": self.params, "z0": self.z0, "unit": self.unit}, f)
+
+def load_mdif_cache(cache_dir):
+    # The arrays are memory mapped, so only the blocks that are used get read
+    with open(os.path.join(cache_dir, "params.json"), "r") as f:
+        meta = json.load(f)
+    return mdifData(np.load(os.path.join(cache_dir, "f.npy"), mmap_mode="r"),
+                    np.load(os.path.join(cache_dir, "s.npy"), mmap_mode="r"),
+                    np.load(os.path.join(cache_dir, "offsets.npy")), meta["params"], meta["z0"], meta["unit"])
+
+def read_mdif(file_name, cache=None):
+    # Reuse the binary cache if it is newer than the file
+    if cache is not None and os.path.isfile(os.path.join(cache, "params.json")):
+        if os.path.getmtime(os.path.join(cache, "params.json")) >= os.path.getmtime(file_name):
+            return load_mdif_cache(cache)
+
+    # First pass: block headers and the number of data lines in each block, so the arrays are only allocated once
+    blocks = []
+    params = {}
+    block = None
+    with open(file_name, "r") as f:
+        for line in f:
+            stripped = line.strip()
+            upper = stripped[:5].upper()
+            if stripped == "" or stripped[0] == "!":
+                continue
+            elif upper.startswith("VAR"):
+                name, value = (x.strip() for x in stripped[3:].split("=", 1))
+                name = name.split("(")[0]
+                try:
+                    params[name] = float(value)
+                except ValueError:
+                    params[name] = value.replace("\"", "")
+            elif upper == "BEGIN":
+                block = {"params": params, "option": ["GHZ", "S", "MA", "R", "50"], "kinds": [], "kind_lines": 0, "lines": 0}
+                params = {}
+            elif upper.startswith("END"):
+                blocks.append(block)
+                block = None
+            elif block is None:
+                continue
+            elif stripped[0] == "#":
+                toks = stripped[1:].split()
+                block["option"] = toks + block["option"][len(toks):]
+            elif stripped[0] == "%":
+                block["kinds"] = block["kinds"] + stripped[1:].split()
+                block["kind_lines"] = block["kind_lines"] + 1
+            else:
+                block["lines"] = block["lines"] + 1
+
+    if len(blocks) == 0:
+        raise Exception(f"No data found in {file_name}.")
+
+    # Map every column pair to its place in the S matrix, names are nIJx or nI_Jx for more than 9 ports
+    kinds = [k.lower() for k in blocks[0]["kinds"][1::2]]
+    pairs = []
+    for k in kinds:
+        ij = k[1:-1]
+        i, j = ij.split("_") if "_" in ij else (ij[0], ij[1:])
+        pairs.append((int(i)-1, int(j)-1))
+    nports = max(max(p) for p in pairs) + 1
+    columns = [i*nports + j for i, j in pairs]
+
+    rows = [b["lines"] // max(b["kind_lines"], 1) for b in blocks]
+    offsets = np.concatenate(([0], np.cumsum(rows))).astype(np.int64)
+    f_all = np.empty(offsets[-1])
+    s_all = np.empty((offsets[-1], nports, nports), dtype=complex)
+    s_flat = s_all.reshape(offsets[-1], nports*nports)
+
+    # Second pass: parse each block's numbers in one go straight into the preallocated arrays
+    b = 0
+    data_lines = []
+    in_block = False
+    with open(file_name, "r") as f:
+        for line in f:
+            stripped = line.strip()
+            upper = stripped[:5].upper()
+            if upper == "BEGIN":
+                in_block = True
+                data_lines = []
+            elif upper.startswith("END") and in_block:
+                option = [x.upper() for x in blocks[b]["option"]]
+                data = np.fromstring(" ".join(data_lines), sep=" ").reshape(rows[b], 1 + 2*len(pairs))
+                start, end = offsets[b], offsets[b+1]
+                f_all[start:end] = data[:, 0] * mdif_units[option[0]]
+                a, c = data[:, 1::2], data[:, 2::2]
+                if option[2] == "RI":
+                    values = a + 1j*c
+                elif option[2] == "MA":
+                    values = a * np.exp(1j*np.pi/180 * c)
+                elif option[2] == "DB":
+                    values = 10**(a/20.0) * np.exp(1j*np.pi/180 * c)
+                else:
+                    raise NotImplementedError(f"Unsupported MDIF format {option[2]}")
+                s_flat[start:end, columns] = values
+                in_block = False
+                b = b+1
+            elif in_block and stripped != "" and stripped[0] not in "!#%":
+                data_lines.append(stripped)
+
+    out = mdifData(f_all, s_all, offsets, [b["params"] for b in blocks], float(blocks[0]["option"][4]),
+                   blocks[0]["option"][0].lower())
+    if cache is not None:
+        out.save(cache)
+    return out
+
+def son_hash(unpacked, options=""):
+    # Hash of the project as it would be written, without the dates in the HEADER block, and of the em options it
+    # is run with. Options only change the key when non-empty, so existing cache entries stay valid.
+    h = hashlib.sha256()
+    if options.split():
+        h.update(f"OPTIONS {' '.join(options.split())}\n".encode())
+    h.update(unpacked["file_header"].encode())
+    for block in unpacked:
+        if block == "file_header":
             continue
-        elif polygon_lines[li].strip() == "VIA POLYGON":
-            via = True
-        elif len(split) == 3:
-            polygons[pind][0] = polygons[pind][0] + split[1:]
-            subheader = True
-        elif len(split) == 2:
-            if not subheader:
-                polygons[pind][0] = polygons[pind][0] + ["",""]
-                subheader = True
-            polygons[pind][1].append(list(map(float,split)))
+        h.update(f"{block}\n".encode())
+        if block == "GEO":
+            h.update(str(unpacked[block]).encode())
+        else:
+            for line in unpacked[block]:
+                if block == "HEADER" and line.split(" ")[0] in ("DAT", "MDATE", "HDATE"):
+                    continue
+                h.update(f"{line}\n".encode())
+        h.update(f"END {block}\n".encode())
+    return h.hexdigest()
+
+def unpack_son(file_name, use_mmap=False):
+    # Single pass over the file. With use_mmap the file is read through a memory map instead of Python's file buffer.
+    with open(file_name, "rb" if use_mmap else "r") as f:
+        if use_mmap:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(file_name) > 0 else None
+            lines = (line.decode() for line in iter(mapped.readline, b"")) if mapped is not None else iter(())
+        else:
+            lines = f
+        # Create a dictionary to hold the different blocks
+        unpacked = {}
+        file_header = []
+        lines = iter(lines)
+        # Everything before HEADER is the file header
+        for line in lines:
+            if line.rstrip("\r\n") == "HEADER":
+                break
+            file_header.append(line)
+        else:
+            line = None
+
+        # Each block runs from its name to END name, GEO lines are kept as they are for sonnetGeo
+        while line is not None:
+            block = line.strip()
+            end = "END " + block
+            contents = []
+            for line in lines:
+                line = line.rstrip("\r\n")
+                if line == end:
+                    break
+                contents.append(line)
+            unpacked[block] = sonnetGeo(contents) if block == "GEO" else [l.strip() for l in contents]
+            line = next(lines, None)
+        if use_mmap and mapped is not None:
+            mapped.close()
+    unpacked["file_header"] = "".join(file_header)
+    return unpacked
 
-    return polygons
+def extract_polygons(unpacked):
+    # Return copies so callers can edit them without touching the project
+    return unpack_geo(unpacked).polygons.tolist()
 
 def extract_box(unpacked):
-    # From the GEO block get the line starting with BOX
-    up = copy(unpacked)
-    geo = unpacked["GEO"].splitlines()
-    box_start = [y for y in range(len(geo)) if "BOX" in geo[y]][0]
-    # Now make an array of all the lines following it with a tab
-    box_end = 0
-    for x in range(box_start+1, len(geo)):
-        tabs_over_spaces = geo[x].replace("      ", "\t")
-        if "\t" not in tabs_over_spaces:
-            box_end = x
-            break
-    geo_box = geo[box_start][4:].split(' ')
-    geo_box[0:6] = list(map(int, geo_box[0:6]))
-    geo_box[6] = float(geo_box[6])
-    layers = geo[box_start+1:box_end]
-    for i in range(len(layers)):
-        layers[i] = layers[i].strip()
-        layers[i] = layers[i].split(' ')
-        layers[i][0:6] = list(map(float, layers[i][0:6]))
-        layers[i][6] = int(layers[i][6])
-        layers[i][7] = layers[i][7].replace("\"", "")
-        if len(layers) > 8:
-            layers[i][8:] = list(map(float, layers[i][8:]))
-    del up
-    return[geo_box, layers]
+    box = unpack_geo(unpacked).box
+    return [list(box[0]), [list(layer) for layer in box[1]]]
 
 def repack_geo(unpacked, polygons=None, ports=None, box=None, drp=None):
     up = copy(unpacked)
+    geo = copy(unpack_geo(unpacked))
 
     if polygons is not None:
-        # Extract the lines relevant to polygons
-        g_lines = [y for y in (x for x in unpacked["GEO"].splitlines()) if y]
-        polygons_start = [i for i in range(len(g_lines)) if "NUM" in g_lines[i]][0]
-       
-        new_polygons = ["NUM "+str(len(polygons))]
-        # Add the new polygons
-        for polygon in polygons:
-            new_polygons.append(' '.join(map(str,polygon[0][:-2])))
-            if(polygon[0][-2] != ""):
-                new_polygons.append("TLAYNAM "+ ' '.join(map(str, polygon[0][-2:])))
-            for v in polygon[1]:
-                new_polygons.append(' '.join(map(str,v)))
-            new_polygons.append("END")
-        new_lines = g_lines[:polygons_start] + new_polygons
-
-        # Re-insert the new polygons
-        #print(new_lines)
-        up["GEO"] = "\n".join(new_lines) + "\n"
+        geo.polygons = polygonStore(polygons)
+        geo.ids = None
+
+    if ports is not None:
+        geo.ports = [copy(port) for port in ports]
 
     if box is not None:
-        # From the GEO block get the line starting with BOX
-        geo = up["GEO"].splitlines()
-        box_start = [y for y in range(len(geo)) if "BOX" in geo[y]][0]
-        # Now make an array of all the lines following it with a tab
-        box_end = 0
-        for x in range(box_start+1, len(geo)):
-            tabs_over_spaces = geo[x].replace("      ", "\t")
-            if "\t" not in tabs_over_spaces:
-                box_end = x
-                break
-        b = copy(box)
-        b[0][0] = len(b[1])-1
-        geo[box_start] = "BOX " + ' '.join(map(str, box[0]))
-        for i in range(len(box[1])):
-            geo[box_start+i+1] = '\t' + ' '.join(map(str, box[1][i][0:7])) + ' "' + box[1][i][7] + '"'
-            if len(box[1][i]) > 8:
-                geo[box_start+i+1] = geo[box_start+i+1] + ' ' + ' '.join(map(str, box[1][i][8:]))
-        up["GEO"] = "\n".join(geo) + "\n"
+        geo.box = box
+
+    up["GEO"] = geo
 
     if drp is not None:
         up = repack_drp(up, drp)
@@ -861,157 +2611,71 @@ def repack_geo(unpacked, polygons=None, ports=None, box=None, drp=None):
 
 
 def extract_ports(unpacked, indices=False):
-    # Extract the lines relevant to ports
-    g_lines = [y for y in (x.strip() for x in unpacked["GEO"].splitlines()) if y]
-
-    if len([i for i in range(len(g_lines)) if "POR1" in g_lines[i]]) == 0:
-        return []
-    
-    port_lines = [i for i in range(len(g_lines)) if "POR1" in g_lines[i]]
-    port_indices_out = copy(port_lines)
-    ports = []
-    port_type = ""
-    pind = -1
-    for i in port_lines:
-        pline = 0
-        while True:
-            if i+pline+1 > len(g_lines):
-                break
-            li = g_lines[i+pline]
-            # If the line contains POR1 it is a new port
-            split = li.split(" ")
-            if "POR1" in split:
-                if pline != 0:
-                    break
-                ports.append({})
-                pind = pind + 1
-                pline = 0
-
-                port_type = split[1]
-                ports[pind]["type"] = port_type
-
-                if port_type == "CUP":
-                    ports[pind]["calib_group"] = split[2]
-            else:
-                if pline == 1:
-                    port_indices_out.append(i+pline)
-                    ports[pind]["poly"] = int(split[1])
-                    ports[pind]["points"] = int(split[2])
-                elif pline == 2:
-                    port_indices_out.append(i+pline)
-                    ports[pind]["vertex"] = int(split[0])
-                elif pline == 3:
-                    port_indices_out.append(i+pline)
-                    ports[pind]["port_number"] = int(split[0])
-                    ports[pind]["resistance"] = float(split[1])
-                    ports[pind]["reactance"] = float(split[2])
-                    ports[pind]["inductance"] = float(split[3])
-                    ports[pind]["capacitance"] = float(split[4])
-                    ports[pind]["x"] = float(split[5])
-                    ports[pind]["y"] = float(split[6])
-                    if port_type == "AGND":
-                        if len(split) < 9:
-                            ports[pind]["agnd_calib_type"] = "NONE"
-                        else: 
-                            ports[pind]["agnd_calib_type"] = split[7]
-                            ports[pind]["agnd_plane_length"] = split[8]
-                            if len(split) == 10:
-                                ports[pind]["agnd_calib_length"] = split[9]
-                elif port_type == "STD":
-                    break
-                elif port_type == "CUP":
-                    if split[0] == "CUPGRP":
-                        port_indices_out.append(i+pline)
-                        ports[pind]["cup_group"] = split[1]
-                        ports[pind]["cup_group_type"] = split[2]
-                    elif split[0] == "ID":
-                        port_indices_out.append(i+pline)
-                        ports[pind]["cup_id"] = int(split[1])
-                    elif split[0] == "GRNDREF":
-                        port_indices_out.append(i+pline)
-                        ports[pind]["cup_grndref"] = split[1]
-                    elif split[0] == "TWTYPE":
-                        port_indices_out.append(i+pline)
-                        ports[pind]["cup_twtype"] = split[1]
-                    else:
-                        break
-            pline = pline + 1
-
     if indices:
-        return port_indices_out
-    return ports
+        # Line numbers of the ports in the GEO block with empty lines removed, counted from the parsed sections
+        # in the order iter_lines writes them, without writing the polygons
+        geo = unpack_geo(unpacked)
+        port_indices = []
+        i = 0
+        for line in geo.lines + ([] if geo_drp_marker in geo.lines else [geo_drp_marker]) \
+                + ([] if geo_port_marker in geo.lines else [geo_port_marker]):
+            if line == geo_box_marker:
+                i = i + len(box_lines(geo.box))
+            elif line == geo_drp_marker:
+                i = i + len(drp_lines(geo.drp))
+            elif line == geo_valvar_marker:
+                i = i + len(geo.valvars)
+            elif line == geo_port_marker:
+                for port in geo.ports:
+                    n = len(port_lines(port))
+                    port_indices = port_indices + list(range(i, i+n))
+                    i = i+n
+            else:
+                i = i+1
+        return port_indices
+    return [copy(port) for port in unpack_geo(unpacked).ports]
 
 def repack_ports(unpacked, ports):
-    geo = unpacked["GEO"].splitlines()
+    geo = copy(unpack_geo(unpacked))
+    geo.ports = [copy(port) for port in ports]
+    unpacked["GEO"] = geo
+    return unpacked
 
 def extract_drp(unpacked):
-    g_lines = [y for y in (x.strip() for x in unpacked["GEO"].splitlines()) if y]
-    drp_headers = [i for i in range(len(g_lines)) if "DRP1" in g_lines[i]]
-
-    if len(drp_headers) == 0:
-        return []
-
-    drp_unpacked = []
-
-    for pline in drp_headers:
-        refp_lines = []
-        # Data structure for linked plane
-
-        drp_type = g_lines[pline].split(' ')[2]
-        drp_dict = {}
-        if drp_type == "LINK":
-            drp_lines = [g_lines[pline+i].split(' ') for i in range(3)]
-            drp_dict["type"] = "LINK"
-            drp_dict["direction"] = drp_lines[0][1]
-            drp_dict["poly_id"] = int(drp_lines[1][1])
-            drp_dict["vertex"] = int(drp_lines[2][0])
-        elif drp_type == "FIX":
-            drp_dict["type"] = "FIX"
-            drp_line = g_lines[pline].split(' ')
-            drp_dict["direction"] = drp_line[1]
-            drp_dict["length"] = float(drp_line[3])
-        drp_unpacked.append(drp_dict)
-    return drp_unpacked
+    return [copy(drp) for drp in unpack_geo(unpacked).drp]
 
 def repack_drp(unpacked, drp):
-    g_lines = [y for y in (x.strip() for x in unpacked["GEO"].splitlines()) if y]
-    drp_headers = [i for i in range(len(g_lines)) if "DRP1" in g_lines[i]]
-    drop_inds = drp_headers.copy()
-    for pline in drp_headers:
-        if g_lines[pline].split(' ')[2] == "LINK":
-            drop_inds.append(pline+1)
-            drop_inds.append(pline+2)
-    trim_g_lines = [g_lines[i] for i in range(len(g_lines)) if i not in drop_inds]
-    drp_lines = []
-    for i in range(len(drp)):
-        if drp[i]["type"] == "LINK":
-            drp_lines = drp_lines + [f"DRP1 {drp[i]['direction']} LINK", f"POLY {drp[i]['poly_id']} 1", f"{drp[i]['vertex']}"]
-        elif drp[i]["type"] == "FIX":
-            drp_lines.append(f"DRP1 {drp[i]['direction']} FIX {drp[i]['length']}")
-    if len(drop_inds) == 0:
-        drop_inds = [0]
-        
-    new_g_lines = trim_g_lines[:drop_inds[0]] + drp_lines + trim_g_lines[drop_inds[0]:]
-    unpacked["GEO"] = "\n".join(new_g_lines) + "\n"
+    geo = copy(unpack_geo(unpacked))
+    geo.drp = list(drp)
+    unpacked["GEO"] = geo
     return unpacked
 
 
 
 def repack_son(file_name, unpacked):
-    up = copy(unpacked)
-    output_string = ""
-    output_string += up.pop("file_header")
-    for block in up:
-        output_string += block + "\n"
-        if block != "GEO":
-            for line in unpacked[block]:
-                output_string += line + "\n"
-        else:
-            output_string += unpacked[block] + "\n"
-        output_string += f"END {block}\n"
-
-    with open(file_name, "w") as f:
-        f.write(output_string)
+    # Written block by block through a buffered file, GEO a chunk of lines at a time
+    with open(file_name, "w", buffering=1 << 20) as f:
+        f.write(unpacked["file_header"])
+        for block in unpacked:
+            if block == "file_header":
+                continue
+            f.write(block + "\n")
+            if block != "GEO":
+                write_lines(f, unpacked[block])
+            elif isinstance(unpacked[block], sonnetGeo):
+                write_lines(f, unpacked[block].iter_lines())
+                f.write("\n")
+            else:
+                f.write(unpacked[block] + "\n")
+            f.write(f"END {block}\n")
+
+def write_lines(f, lines, chunk=10000):
+    lines = iter(lines)
+    while True:
+        part = list(itertools.islice(lines, chunk))
+        if len(part) == 0:
+            break
+        f.write("\n".join(part) + "\n")
 
 def param_exists(unpacked, block, param):
     for line in unpacked[block]:
@@ -1021,6 +2685,7 @@ def param_exists(unpacked, block, param):
 
 def replace_param(unpacked, block, param, value):
     up = copy(unpacked)
+    up[block] = list(unpacked[block])
     v = ""
     if isinstance(value, list):
         for i in value:
@@ -1041,20 +2706,100 @@ def replace_param(unpacked, block, param, value):
     return up
 
 
-def new_son(file_name, sonnet_path="", temp=False,  ml_backend=False, overwrite=None):
+class matlabPool:
+    # Warm MATLAB engines shared between Matlab backend projects. Each project gets its own workspace variable, so
+    # several projects can use the same engine, and is put on the engine with the fewest projects.
+    def __init__(self, size=1, sonnetlab="sonnetlab"):
+        if not matlab_available():
+            raise Exception("Matlab engine not available")
+        self.size = size
+        self.sonnetlab = sonnetlab
+        # Reentrant, release can be called from sonnetFile.__del__ by the garbage collector while borrow holds it
+        self.lock = threading.RLock()
+        self.names = itertools.count(1)
+        # Start every engine at once, MATLAB takes a while to start
+        starting = [matlab_engine.start_matlab(background=True) for _ in range(size)]
+        self.engines = [self.setup(future.result()) for future in starting]
+        self.projects = {id(eng): set() for eng in self.engines}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def setup(self, eng):
+        genpath = eng.genpath(self.sonnetlab)
+        eng.addpath(genpath, nargout=0)
+        return eng
+
+    def healthy(self, eng):
+        try:
+            eng.eval("1;", nargout=0)
+            return True
+        except Exception:
+            return False
+
+    def borrow(self):
+        # Returns an engine and a workspace variable name for a new project
+        with self.lock:
+            eng = min(self.engines, key=lambda e: len(self.projects[id(e)]))
+            if not self.healthy(eng):
+                # Replace dead engines, their projects are gone with them
+                self.engines.remove(eng)
+                del self.projects[id(eng)]
+                eng = self.setup(matlab_engine.start_matlab())
+                self.engines.append(eng)
+                self.projects[id(eng)] = set()
+            var = f"Project{next(self.names)}"
+            self.projects[id(eng)].add(var)
+            return eng, var
+
+    def release(self, eng, var):
+        # Clears a project's workspace variables and leaves the engine running for the next one
+        with self.lock:
+            if id(eng) not in self.projects:
+                return
+            self.projects[id(eng)].discard(var)
+            try:
+                eng.eval(f"clear {var} {var}_id {var}_ids;", nargout=0)
+            except Exception:
+                pass
+
+    def shutdown(self):
+        with self.lock:
+            for eng in self.engines:
+                try:
+                    eng.quit()
+                except Exception:
+                    pass
+            self.engines = []
+            self.projects = {}
+
+# Pool used when open_son / new_son aren't given one
+default_matlab_pool = None
+
+def shared_matlab_pool():
+    global default_matlab_pool
+    if default_matlab_pool is None or len(default_matlab_pool.engines) == 0:
+        default_matlab_pool = matlabPool()
+    return default_matlab_pool
+
+def new_son(file_name, sonnet_path="", temp=False,  ml_backend=False, overwrite=None, pool=None):
     if ml_backend:
-        if not ml_import:
+        if not matlab_available():
             raise Exception("Matlab engine not available")
 
-        if overwrite is None:
-            eng = matlab.engine.start_matlab()
-            genpath = eng.genpath('sonnetlab')
-            eng.addpath(genpath, nargout=0)
+        if overwrite is not None and overwrite.ml_pool is not None:
+            pool = overwrite.ml_pool
+        if overwrite is None or pool is not None:
+            pool = pool if pool is not None else shared_matlab_pool()
+            eng, var = pool.borrow()
         else:
-            eng = overwrite.eng
-        eng.eval("Project = SonnetProject();", nargout=0)
-        eng.eval(f"Project.saveAs(\"{file_name}\");", nargout=0)
-        return sonnetFile(file_name, temp, sonnet_path=sonnet_path, eng=eng)
+            eng, var = overwrite.eng, "Project"
+        eng.eval(f"{var} = SonnetProject();", nargout=0)
+        eng.eval(f"{var}.saveAs(\"{file_name}\");", nargout=0)
+        return sonnetFile(file_name, temp, sonnet_path=sonnet_path, eng=eng, ml_var=var, ml_pool=pool)
     else:
         new_file = {'HEADER': [f'DAT {datetime.now().strftime("%d/%m/%Y %H:%M:%S")}',
           f'BUILT_BY_CREATED PySon v{pyson_version}',
@@ -1080,23 +2825,24 @@ def new_son(file_name, sonnet_path="", temp=False,  ml_backend=False, overwrite=
         return sonnetFile(file_name, temp=temp, sonnet_path=sonnet_path)
 
 
-def open_son(file_name, sonnet_path="", temp=False,  ml_backend=False, overwrite=None):
+def open_son(file_name, sonnet_path="", temp=False,  ml_backend=False, overwrite=None, pool=None):
     if ml_backend:
-        if not ml_import:
+        if not matlab_available():
             raise Exception("Matlab engine not available")
-        if overwrite is None:
-            eng = matlab.engine.start_matlab()
-            genpath = eng.genpath('sonnetlab')
-            eng.addpath(genpath, nargout=0)
+        if overwrite is not None and overwrite.ml_pool is not None:
+            pool = overwrite.ml_pool
+        if overwrite is None or pool is not None:
+            pool = pool if pool is not None else shared_matlab_pool()
+            eng, var = pool.borrow()
         else:
-            eng = overwrite.eng
-        eng.eval(f"Project = SonnetProject(\"{file_name}\");", nargout=0)
-        return sonnetFile(file_name, temp, eng=eng, sonnet_path=sonnet_path)
+            eng, var = overwrite.eng, "Project"
+        eng.eval(f"{var} = SonnetProject(\"{file_name}\");", nargout=0)
+        return sonnetFile(file_name, temp, eng=eng, sonnet_path=sonnet_path, ml_var=var, ml_pool=pool)
     else:
         return sonnetFile(file_name, temp, sonnet_path=sonnet_path)
 
 
-def from_template(file_name, new_file="", temp=False, sonnet_path="", overwrite=None, ml_backend=False):
+def from_template(file_name, new_file="", temp=False, sonnet_path="", overwrite=None, ml_backend=False, pool=None):
     file_out = ""
     if new_file == "":
         i = 1
@@ -1113,4 +2859,4 @@ def from_template(file_name, new_file="", temp=False, sonnet_path="", overwrite=
             for line in f:
                 f1.write(line)
 
-    return open_son(file_out, temp=temp, sonnet_path=sonnet_path, overwrite=overwrite, ml_backend=ml_backend)
+    return open_son(file_out, temp=temp, sonnet_path=sonnet_path, overwrite=overwrite, ml_backend=ml_backend, pool=pool)
@@ -0,0 +1,329 @@
+import json
+import os
+import subprocess
+import sys
+import warnings
+
+import numpy as np
+import pytest
+
+import pyson
+
+warnings.simplefilter("ignore")
+
+square = ([0, 10, 10, 0], [0, 0, 10, 10])
+
+def header(poly_id):
+    return [0, 5, -1, 'N', poly_id, 1, 1, 100, 100, 0, 0, 0, 'Y', '', '']
+
+@pytest.fixture
+def project(tmp_path):
+    return pyson.new_son(str(tmp_path / "test.son"))
+
+def test_header_ids_mixed_with_allocated_ids(project):
+    ids = [project.add_metal_polygon(0, *square), project.add_metal_polygon(0, *square)]
+    ids.append(project.add_metal_polygon(0, *square, header=header(4)))
+    project.geo().polygons.append([header(7), [[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]])
+    ids = ids + [project.add_metal_polygon(0, *square) for _ in range(4)]
+
+    assert ids[2] == 4
+    stored = project.geo().polygons.headers["id"].tolist()
+    assert len(set(stored)) == len(stored)
+    assert set(ids) | {7} == set(stored)
+
+def test_ids_after_replacing_polygons(project):
+    project.add_metal_polygon(0, *square)
+    project.geo().polygons = [[header(1), [[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]],
+                              [header(2), [[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]]]
+    assert project.add_metal_polygon(0, *square) == 3
+
+class fakeEngine:
+    # Stands in for a MATLAB engine, records the code it is asked to run
+    def __init__(self):
+        self.calls = []
+        self.workspace = {}
+
+    def eval(self, code, nargout=1):
+        self.calls.append(code)
+        if "_id = " in code:
+            self.workspace[code.split(" = ")[0]] = len(self.calls)
+        return None
+
+    def quit(self):
+        pass
+
+@pytest.fixture
+def ml_project(tmp_path):
+    file_name = str(tmp_path / "ml.son")
+    pyson.new_son(file_name).save()
+    return pyson.sonnetFile(file_name, False, eng=fakeEngine(), ml_var="Project")
+
+def test_ml_add_metal_polygons_command(ml_project):
+    ml_project.add_metal_polygons(0, np.array([[[0, 0], [10, 0], [10, 5]]], dtype=float))
+    code = "\n".join(ml_project.eng.calls)
+    assert "np." not in code
+    assert "Project.addMetalPolygonEasy(0, [0.0; 10.0; 10.0], Project.yBoxSize() - [0.0; 0.0; 5.0]).DebugId" in code
+
+def test_ml_add_via_polygon_command(ml_project):
+    ml_project.add_via_polygon(0, 1, np.array([0, 5, 5, 0]), np.array([0, 0, 5, 5], dtype=float))
+    assert ml_project.eng.calls[-1] == \
+        "Project.addViaPolygonEasy(0, 1, [0.0; 5.0; 5.0; 0.0], Project.yBoxSize() - [0.0; 0.0; 5.0; 5.0]);"
+
+def test_port_on_missing_edge(project):
+    first = project.add_metal_polygon(0, *square)
+    project.add_metal_polygon(0, *square)
+    with pytest.raises(IndexError):
+        project.add_std_ports([first], [4])
+    assert len(project.geo().ports) == 0
+
+def test_feedline_on_missing_edge(project):
+    first = project.add_metal_polygon(0, [50, 60, 60, 50], [50, 50, 60, 60])
+    project.add_metal_polygon(0, *square)
+    with pytest.raises(IndexError):
+        project.add_feedlines([(first, 4)])
+    assert len(project.geo().polygons) == 2
+
+def test_feedline_orientation(project):
+    # Edge 0 is the bottom edge of a counterclockwise square and the top edge of a clockwise one
+    ccw = project.add_metal_polygon(0, [50, 60, 60, 50], [50, 50, 60, 60])
+    cw = project.add_metal_polygon(0, [100, 110, 110, 100], [60, 60, 50, 50])
+    project.add_feedlines([(ccw, 0), (cw, 0)])
+    assert [drp["direction"] for drp in project.geo().drp] == ["BOTTOM", "TOP"]
+
+def add_via(project, x, y, poly_id):
+    project.geo().raw_polygons.append([f"0 5 0 V {poly_id} 1 1 100 100 0 0 0 Y", "TOLEVEL 1 RING COVERS",
+                                       f"{x} {y}", f"{x+5} {y}", f"{x+5} {y+5}", f"{x} {y+5}", f"{x} {y}"])
+
+def test_crop_moves_and_drops_vias(project):
+    pytest.importorskip("shapely")
+    project.add_metal_polygon(0, [20, 80, 80, 20], [20, 20, 80, 80])
+    add_via(project, 30, 30, 50)
+    add_via(project, 58, 30, 51)
+    add_via(project, 100, 100, 52)
+    tiles = project.crop_many([(20, 20, 60, 60)])
+    project.crop(20, 20, 60, 60)
+    for geo in (project.geo(), tiles[0].geo()):
+        assert len(geo.raw_polygons) == 1
+        assert geo.raw_polygons[0][2].split() == ["10", "10"]
+        assert geo.raw_polygons[0][1] == "TOLEVEL 1 RING COVERS"
+
+sonnet_text = """FTYP SONPROJ 16.52 ! Sonnet Project File
+VER 16.52
+HEADER
+DAT 01/01/2024 00:00:00
+END HEADER
+DIM
+LNG UM
+FREQ GHZ
+END DIM
+FREQ
+ABS 6 8
+END FREQ
+CONTROL
+ABS
+SPEED 0
+END CONTROL
+GEO
+TMET "Lossless" 0 SUP 0 0 0 0
+BMET "Lossless" 0 SUP 0 0 0 0
+BOX 2 160 160 32 32 20 0
+      50 1 1 0 0 0 0 "Air"
+      50 11.7 1 0 0 0 0 "Silicon"
+      50 11.9 1 0 0 0 0 "Sapphire" A 11.9 1 0 0 0
+VALVAR W LNG 10 "width"
+POR1 STD
+POLY 1 1
+3
+1 50 0 0 0 20 80
+NUM 3
+0 5 -1 N 1 1 1 100 100 0 0 0 Y
+20 20
+60 20
+60 140.5
+20 140.5
+20 20
+END
+0 5 0 V 3 1 1 100 100 0 0 0 Y
+TOLEVEL 1 RING COVERS
+30 30
+35 30
+35 35
+30 35
+30 30
+END
+0 5 -1 N 2 1 1 100 100 0 0 0 Y
+100 20
+140 20
+140 60
+100 60
+100 20
+END
+
+END GEO
+OPT
+MAX 100
+END OPT
+FILEOUT
+END FILEOUT
+"""
+
+def test_unchanged_project_round_trips(tmp_path):
+    file_name = tmp_path / "sonnet.son"
+    file_name.write_text(sonnet_text)
+    project = pyson.open_son(str(file_name))
+    project.save(str(tmp_path / "saved.son"))
+    assert (tmp_path / "saved.son").read_text() == sonnet_text
+
+def test_ml_import_is_a_bool():
+    assert pyson.ml_import is pyson.matlab_available()
+    assert isinstance(pyson.ml_import, bool)
+
+def test_ml_add_std_port(ml_project):
+    ml_project.add_std_port(5, 0, port_number=2)
+    with ml_project.batch():
+        ml_project.add_std_port(6, 1)
+        assert ml_project.eng.calls[-1] == "Project.addPortToPolygon(5, 2);"
+    # Queued in the batch and sent in one eval when it ends
+    assert any("Project.addPortToPolygon(6);" in code.splitlines() for code in ml_project.eng.calls)
+
+class fakeSweep:
+    names = ["W"]
+    coords = {"W": [1, 2]}
+    points = [(1,), (2,)]
+    grid = True
+
+def test_sweep_result_all_failed():
+    networks = np.empty(2, dtype=object)
+    result = pyson.sweepResult(fakeSweep(), networks, {(1,): RuntimeError("em failed"), (2,): RuntimeError("timeout")})
+    with pytest.raises(Exception, match="em failed"):
+        result.s()
+    with pytest.raises(Exception, match="timeout"):
+        result.frequency()
+
+def test_cache_key_includes_options(project, tmp_path):
+    cache = pyson.simulationCache(str(tmp_path / "cache"))
+    assert cache.key(project) == cache.key(project, "")
+    assert cache.key(project, "-ParallelSweep") != cache.key(project)
+    assert cache.key(project, "-ParallelSweep") == cache.key(project, " -ParallelSweep ")
+
+def test_select_levels():
+    levels = np.array([0, 2, 1])
+    assert pyson.select_levels(levels, None) == [2]
+    assert pyson.select_levels(np.array([], dtype=int), None) == []
+    assert pyson.select_levels(levels, 1) == [1]
+    assert pyson.select_levels(levels, range(2)) == [0, 1]
+
+def test_cache_concurrent_put(tmp_path):
+    import threading
+    import skrf as rf
+    cache = pyson.simulationCache(str(tmp_path / "cache"), max_size=1)
+    networks = rf.NetworkSet([rf.Network(f=[1, 2], s=np.zeros((2, 1, 1)), name="a")], name="result")
+    errors = []
+    def worker(i):
+        try:
+            for j in range(20):
+                cache.put(f"{i}-{j}", networks)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+class brokenCache:
+    def put(self, key, networks):
+        raise OSError("disk full")
+
+class fakeMdif:
+    def to_networkset(self):
+        return "networks"
+
+def test_run_job_cache_failure(tmp_path, monkeypatch):
+    monkeypatch.setattr(pyson.subprocess, "run", lambda command, cwd: None)
+    monkeypatch.setattr(pyson, "read_mdif", lambda file_name: fakeMdif())
+    (tmp_path / "job.mdf").write_text("")
+    pool = pyson.simulationPool(workers=1, cache=brokenCache())
+    with pytest.warns(UserWarning, match="disk full"):
+        assert pool.run_job(["em"], str(tmp_path), str(tmp_path / "job.mdf"), key="key") == "networks"
+    pool.shutdown()
+
+def test_fork_copies_on_one_side_only(project):
+    project.add_metal_polygon(0, *square)
+    geo = project.geo()
+    store = geo.polygon_store
+    variant = project.fork()
+    variant.add_metal_polygon(0, *square)
+    assert len(variant.geo().polygons) == 2
+    # The fork copied, the template is the last one holding its blocks and changes them in place
+    project.add_metal_polygon(0, *square)
+    assert project.geo() is geo
+    assert project.geo().polygon_store is store
+    assert len(project.geo().polygons) == 2
+    assert variant.geo().polygon_store is not store
+
+def test_batch_shares_blocks_until_changed(project):
+    project.add_metal_polygon(0, *square)
+    store = project.geo().polygon_store
+    with project.batch():
+        project.set_speed(1)
+    # Nothing in the batch touched the polygons, so they were never copied
+    assert project.geo().polygon_store is store
+    with pytest.raises(RuntimeError):
+        with project.batch():
+            project.add_metal_polygon(0, *square)
+            raise RuntimeError()
+    assert project.geo().polygon_store is store
+    assert len(project.geo().polygons) == 1
+    # Back to being the only holder, so later edits are made in place
+    project.add_metal_polygon(0, *square)
+    assert project.geo().polygon_store is store
+
+def test_simulate_inside_batch(project):
+    with project.batch():
+        with pytest.raises(Exception, match="batch"):
+            project.simulate_network()
+
+# Seconds import pyson may take in a fresh interpreter, the default budget of benchmark.py
+import_budget = 0.5
+
+def test_import_time_and_lazy_modules():
+    code = ("from time import perf_counter; start = perf_counter(); import pyson; elapsed = perf_counter() - start; "
+            "import sys, json; print(json.dumps([elapsed, [m for m in ('matplotlib', 'shapely', 'matlab.engine') "
+            "if m in sys.modules]]))")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = [json.loads(subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True,
+                                      check=True).stdout) for _ in range(3)]
+    assert min(elapsed for elapsed, _ in runs) < import_budget
+    assert runs[0][1] == []
+
+class fakePoolEngine(fakeEngine):
+    def genpath(self, path):
+        return path
+
+    def addpath(self, path, nargout=0):
+        pass
+
+    def result(self):
+        return self
+
+class fakeMatlab:
+    def start_matlab(self, background=False):
+        return fakePoolEngine()
+
+def test_matlab_pool_release_inside_lock(monkeypatch):
+    import threading
+    monkeypatch.setattr(pyson, "matlab_available", lambda: True)
+    monkeypatch.setattr(pyson, "matlab_engine", fakeMatlab())
+    pool = pyson.matlabPool()
+    eng, var = pool.borrow()
+    # As if the project were finalized by the garbage collector while borrow holds the lock
+    def finalize():
+        with pool.lock:
+            pool.release(eng, var)
+    thread = threading.Thread(target=finalize, daemon=True)
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert pool.projects[id(eng)] == set()